@@ -76,6 +76,39 @@ function locateUser() {
     mymap.locate({setView : true});
 }
 
+// Offset to sunrise or sunset: minutes, or seconds if followed by 's'
+function offsetText(offset) {
+   if (offset.substring(offset.length - 1) == "s") {
+      return offset.substring(0, offset.length - 1) + " seconds";
+   }
+   return offset + " minutes";
+}
+
+// Fill the offset fields of a sunrise or sunset block from the text after the event name
+function setOffsetFields(block, offset) {
+   offset = offset.replace("+", "");
+   var unit = "";
+   if (offset.substring(offset.length - 1) == "s") {
+      unit = "s";
+      offset = offset.substring(0, offset.length - 1);
+   }
+   block.find('#clockDelayVal').val(offset || 0);
+   block.find('.clockDelayUnit').val(unit);
+   block.find('input.clockDelay').attr('data-slider-value', Math.round(parseFloat(offset || 0)));
+}
+
+// The text after the event name for the offset fields of a sunrise or sunset block
+function getOffsetText(block) {
+   var offset = parseFloat(block.find('#clockDelayVal').val()) || 0;
+   var unit = block.find('.clockDelayUnit').val() || "";
+   if (offset > 0) {
+      return "+" + offset + unit;
+   } else if (offset < 0) {
+      return offset + unit;
+   }
+   return "";
+}
+
 function prettyPrintSchedule(evt, shutters) {
    outstr = ""
    if (evt['active'] == "paused") {
@@ -104,17 +137,17 @@ function prettyPrintSchedule(evt, shutters) {
    } else if (evt['timeType'] == "astro") {
       if (evt['timeValue'].substring(0, 6) == "sunset") {
          if (evt['timeValue'].substring(6, 7) == "+") {
-            outstr += evt['timeValue'].substring(7) + " minutes after sunset, ";
+            outstr += offsetText(evt['timeValue'].substring(7)) + " after sunset, ";
          } else if (evt['timeValue'].substring(6, 7) == "-") {
-            outstr += evt['timeValue'].substring(7) + " minutes before sunset, ";
+            outstr += offsetText(evt['timeValue'].substring(7)) + " before sunset, ";
          } else {
             outstr += "at sunset, "
          }
       } else if (evt['timeValue'].substring(0, 7) == "sunrise") {
          if (evt['timeValue'].substring(7, 8) == "+") {
-            outstr += evt['timeValue'].substring(8) + " minutes after sunrise, ";
+            outstr += offsetText(evt['timeValue'].substring(8)) + " after sunrise, ";
          } else if (evt['timeValue'].substring(7, 8) == "-") {
-            outstr += evt['timeValue'].substring(8) + " minutes before sunrise, ";
+            outstr += offsetText(evt['timeValue'].substring(8)) + " before sunrise, ";
          } else {
             outstr += "at sunrise, ";
          }
@@ -345,13 +378,11 @@ function setupTableSchedule () {
         } else if ((evt['timeType'] == "astro") && (evt['timeValue'].substring(0, 7) == "sunrise")) {
            thisRow.find('#scheduleEdit .timeType[data-optionvalue="sunrise"]').addClass('in').show();
            thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunrise"]').addClass('in').show();
-           thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunrise"] input').val(evt['timeValue'].substring(7).replace("+", "") || 0);
-           thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunrise"] input.clockDelay').attr('data-slider-value', evt['timeValue'].substring(7).replace("+", "") || 0);
+           setOffsetFields(thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunrise"]'), evt['timeValue'].substring(7));
         } else if ((evt['timeType'] == "astro") && (evt['timeValue'].substring(0, 6) == "sunset")) {
            thisRow.find('#scheduleEdit .timeType[data-optionvalue="sunset"]').addClass('in').show();
            thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunset"]').addClass('in').show();
-           thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunset"] input').val(evt['timeValue'].substring(6).replace("+", "") || 0);
-           thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunset"] input.clockDelay').attr('data-slider-value', evt['timeValue'].substring(6).replace("+", "") || 0);
+           setOffsetFields(thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunset"]'), evt['timeValue'].substring(6));
         }
         
         thisRow.find('#scheduleEdit .timeType[data-optionvalue="'+evt['timeType']+'"]').addClass('in').show();
@@ -432,14 +463,14 @@ function setupTableSchedule () {
 
 
 function clockDelayValUpdate(obj) {
-   if ($(obj).val() !=  parseInt($(obj).val())){
+   if ($(obj).val() !=  parseFloat($(obj).val())){
       $(obj).val(0)
-   } else if (parseInt($(obj).val()) > 300) {
+   } else if (parseFloat($(obj).val()) > 300) {
       $(obj).val(300)
-   } else if (parseInt($(obj).val()) < -300) {
+   } else if (parseFloat($(obj).val()) < -300) {
       $(obj).val(-300)
    }
-   $(obj).parent().find(".clockDelay").bootstrapSlider('setValue', $(obj).val());
+   $(obj).parent().find(".clockDelay").bootstrapSlider('setValue', Math.round(parseFloat($(obj).val())));
 }
     
 function setupListeners() {
@@ -600,23 +631,9 @@ function setupListeners() {
            if (timeTypeTemp == "clock") {
               mydata['timeValue'] = timeValueField.val()
            } else if (timeTypeTemp == "sunrise") {
-              var mytmp = thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunrise"] #clockDelayVal').val()
-              if (parseInt(mytmp) == 0) {
-                  mydata['timeValue'] = "sunrise"
-              } else if (parseInt(mytmp) > 0) {
-                  mydata['timeValue'] = "sunrise+"+parseInt(mytmp)
-              } else if (parseInt(mytmp) < 0) {
-                  mydata['timeValue'] = "sunrise"+parseInt(mytmp)
-              }
+              mydata['timeValue'] = "sunrise" + getOffsetText(thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunrise"]'))
            } else if (timeTypeTemp == "sunset") {
-              var mytmp = thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunset"] #clockDelayVal').val()
-              if (parseInt(mytmp) == 0) {
-                  mydata['timeValue'] = "sunset"
-              } else if (parseInt(mytmp) > 0) {
-                  mydata['timeValue'] = "sunset+"+parseInt(mytmp)
-              } else if (parseInt(mytmp) < 0) {
-                  mydata['timeValue'] = "sunset"+parseInt(mytmp)
-              }
+              mydata['timeValue'] = "sunset" + getOffsetText(thisRow.find('#scheduleEdit .timeValue[data-optionvalue="sunset"]'))
            }
            mydata['repeatType'] = thisRow.find("#scheduleEdit .repeatType.in").attr('data-optionvalue');
            if (mydata['repeatType'] == "once") {
@@ -1,23 +1,117 @@
 #!/usr/bin/python3
 
+import os
+import atexit
 import threading
+from contextlib import contextmanager
 try:
     from ConfigParser import RawConfigParser
 except ImportError as e:
     from configparser import RawConfigParser
 
 from mylog import MyLog
+from mymotion import TravelProfile
+
+class RollingCodeJournal (MyLog):
+    #---------------------RollingCodeJournal::__init__--------------------------
+    # Append-only journal of the rolling codes. Codes are reserved in blocks:
+    # a line "<shutterId> <ceiling>" means that codes below the ceiling may have
+    # been used already, so after a crash codes may be skipped but never reused.
+    # The journal is compacted to one line per shutter once it gets long.
+    def __init__(self, filename, blockSize = 16, compactAfter = 1000, log = None):
+
+        super(RollingCodeJournal, self).__init__()
+        self.log = log
+        self.FileName = filename
+        self.BlockSize = max(1, blockSize)
+        self.CompactAfter = compactAfter
+        self.Lock = threading.Lock()
+        self.Ceilings = {}
+        self.Lines = 0
+
+    #---------------------RollingCodeJournal::Load------------------------------
+    def Load(self):
+
+        self.Ceilings = {}
+        self.Lines = 0
+        try:
+            if os.path.isfile(self.FileName):
+                with open(self.FileName, "r") as JournalFile:
+                    for line in JournalFile:
+                        fields = line.split()
+                        # ignore a partially written last line
+                        if len(fields) != 2 or not fields[1].isdigit():
+                            continue
+                        self.Lines += 1
+                        self.Ceilings[fields[0]] = max(self.Ceilings.get(fields[0], 0), int(fields[1]))
+        except Exception as e1:
+            self.LogErrorLine("Error in RollingCodeJournal:Load: " + str(e1))
+        return self.Ceilings
+
+    #---------------------RollingCodeJournal::GetCeiling------------------------
+    def GetCeiling(self, shutterId):
+
+        return self.Ceilings.get(shutterId, 0)
+
+    #---------------------RollingCodeJournal::Reserve---------------------------
+    # Make sure all codes below 'code' are covered by a persisted reservation
+    def Reserve(self, shutterId, code):
+
+        with self.Lock:
+            if code <= self.Ceilings.get(shutterId, 0):
+                return True
+            ceiling = code + self.BlockSize - 1
+            try:
+                with open(self.FileName, "a") as JournalFile:
+                    JournalFile.write(shutterId + " " + str(ceiling) + "\n")
+                    JournalFile.flush()
+                    os.fsync(JournalFile.fileno())
+                self.Ceilings[shutterId] = ceiling
+                self.Lines += 1
+            except Exception as e1:
+                self.LogError("Error in RollingCodeJournal:Reserve: " + str(e1))
+                return False
+
+            if self.Lines > self.CompactAfter:
+                self.Compact()
+            return True
+
+    #---------------------RollingCodeJournal::Compact---------------------------
+    # Rewrite the journal with a single line per shutter. Called with the lock held.
+    def Compact(self):
+
+        try:
+            tmpFileName = self.FileName + ".tmp"
+            with open(tmpFileName, "w") as JournalFile:
+                for shutterId, ceiling in sorted(self.Ceilings.items()):
+                    JournalFile.write(shutterId + " " + str(ceiling) + "\n")
+                JournalFile.flush()
+                os.fsync(JournalFile.fileno())
+            os.replace(tmpFileName, self.FileName)
+            self.Lines = len(self.Ceilings)
+            self.LogDebug("Rolling code journal compacted to " + str(self.Lines) + " entries")
+        except Exception as e1:
+            self.LogError("Error in RollingCodeJournal:Compact: " + str(e1))
+
 
 class MyConfig (MyLog):
     #---------------------MyConfig::__init__------------------------------------
-    def __init__(self, filename = None, section = None, log = None):
+    # A read only config never writes the conf file: changes stay in memory
+    def __init__(self, filename = None, section = None, log = None, readOnly = False):
 
         super(MyLog, self).__init__()
         self.log = log
         self.FileName = filename
+        self.ReadOnly = readOnly
         self.Section = section
-        self.CriticalLock = threading.Lock()        # Critical Lock (writing conf file)
+        self.CriticalLock = threading.RLock()       # Critical Lock (in-memory model of the conf file)
+        self.FlushLock = threading.Lock()           # Serializes writes of the conf file
         self.InitComplete = False
+        self.FileLines = []                         # the conf file as it will be written, comments included
+        self.Dirty = False
+        self.FlushTimer = None
+        self.FlushDelay = 2.0                       # seconds changes are batched before writing the conf file
+        self.TransactionDepth = 0
 
         self.LogLocation = "/var/log/"
         self.Latitude = 51.4769
@@ -28,14 +122,30 @@ class MyConfig (MyLog):
         self.HTTPSPort = 443
         self.RTS_Address = "0x279620"
         self.MQTT_ClientID = "somfy-mqtt-bridge"
+        self.MQTT_PositionDelta = 5
+        self.TXQueueSize = 64
+        self.TXChunkFrames = 1
+        self.TXFrameBudget = 4.0
+        self.Radio = "pigpio"
+        self.SimulatedTimeScale = 1.0
+        self.RollingCodeBlock = 16
+        self.ScheduleDeadline = 30.0
+        self.ScheduleCatchUp = 3600.0
+        self.ScheduleStagger = 0.0
         self.Shutters = {}
         self.ShuttersByName = {}
         self.Schedule = {}
         self.Password = ""
+        self.CodeJournal = None
 
         try:
             self.config = RawConfigParser()
-            self.config.read(self.FileName)
+            if self.FileName != None and os.path.isfile(self.FileName):
+                with open(self.FileName, "r") as ConfigFile:
+                    self.FileLines = ConfigFile.read().splitlines()
+                self.config.read_string("\n".join(self.FileLines) + "\n")
+            if not self.ReadOnly:
+                atexit.register(self.Flush)
 
             if self.Section == None:
                 SectionList = self.GetSections()
@@ -50,7 +160,7 @@ class MyConfig (MyLog):
     # -------------------- MyConfig::LoadConfig-----------------------------------
     def LoadConfig(self):
 
-        parameters = {'LogLocation': str, 'Latitude': float, 'Longitude': float, 'SendRepeat': int, 'UseHttps': bool, 'HTTPPort': int, 'HTTPSPort': int, 'TXGPIO': int, 'RTS_Address': str, "Password": str}
+        parameters = {'LogLocation': str, 'Latitude': float, 'Longitude': float, 'SendRepeat': int, 'UseHttps': bool, 'HTTPPort': int, 'HTTPSPort': int, 'TXGPIO': int, 'RTS_Address': str, "Password": str, 'TXQueueSize': int, 'TXChunkFrames': int, 'TXFrameBudget': float, 'Radio': str, 'SimulatedTimeScale': float, 'RollingCodeBlock': int, 'ScheduleDeadline': float, 'ScheduleCatchUp': float, 'ScheduleStagger': float}
         
         self.SetSection("General");
         for key, type in parameters.items():
@@ -61,7 +171,7 @@ class MyConfig (MyLog):
                 self.LogErrorLine("Missing config file or config file entries in Section General for key "+key+": " + str(e1))
                 return False
 
-        parameters = {'MQTT_Server': str, 'MQTT_Port': int, 'MQTT_User': str, 'MQTT_Password': str, 'MQTT_ClientID': str, 'EnableDiscovery': bool}
+        parameters = {'MQTT_Server': str, 'MQTT_Port': int, 'MQTT_User': str, 'MQTT_Password': str, 'MQTT_ClientID': str, 'EnableDiscovery': bool, 'MQTT_PositionDelta': int}
         
         self.SetSection("MQTT");
         for key, type in parameters.items():
@@ -72,6 +182,11 @@ class MyConfig (MyLog):
                 self.LogErrorLine("Missing config file or config file entries in Section General for key "+key+": " + str(e1))
                 return False
 
+        self.CodeJournal = None
+        if self.FileName != None:
+            self.CodeJournal = RollingCodeJournal(self.FileName + ".codes", blockSize = self.RollingCodeBlock, log = self.log)
+            self.CodeJournal.Load()
+
         self.SetSection("Shutters");
         shutters = self.GetList();
         for key, value in shutters:
@@ -89,13 +204,20 @@ class MyConfig (MyLog):
                    groupParam = self.ReadValue(key, section="ShutterGroups", return_type=str)
                    groupedIds = []
                    if (groupParam != None):
-                       groupedIds = groupParam.split(",")
+                       groupedIds = [memberId.strip().lower() for memberId in groupParam.split(",") if memberId.strip() != ""]
                    
+                   if (self.CodeJournal != None) and (self.CodeJournal.GetCeiling(hex(int(key,16))) > param2):
+                       # codes up to the reserved ceiling may have been sent already
+                       param2 = self.CodeJournal.GetCeiling(hex(int(key,16)))
+                       if not self.ReadOnly:
+                           self.WriteValue(key, str(param2), section="ShutterRollingCodes")
                    self.Shutters[key] = {'name': param1[0], 'code': param2, 'duration': int(param1[2]), 'intermediatePosition': param3, 'groupedShutterIds': groupedIds}
                    self.ShuttersByName[param1[0]] = key
+                   self.getTravelProfile(key)
             except Exception as e1:
                 self.LogErrorLine("Missing config file or config file entries in Section Shutters for key "+key+": " + str(e1))
                 return False
+        self.CompileGroups()
                                    
         self.SetSection("Scheduler")
         schedules = self.GetList()
@@ -110,18 +232,67 @@ class MyConfig (MyLog):
                                    
         return True
 
+    #---------------------MyConfig::CompileGroups-------------------------------
+    # Flatten the groups: every shutter gets in 'groupMembers' the de-duplicated
+    # list of the shutters it controls, directly or through other groups. Group
+    # entries referring to unknown shutters or closing a cycle are rejected.
+    def CompileGroups(self):
+        for shutterId in self.Shutters:
+            members = []
+            self.CollectGroupMembers(shutterId, [shutterId], members)
+            self.Shutters[shutterId]['groupMembers'] = tuple(members)
+
+    def CollectGroupMembers(self, shutterId, path, members):
+        groupedIds = self.Shutters[shutterId].setdefault('groupedShutterIds', [])
+        for memberId in list(groupedIds):
+            if memberId not in self.Shutters:
+                self.LogError("Ignoring unknown shutter " + memberId + " in the group of " + shutterId)
+                groupedIds.remove(memberId)
+            elif memberId in path:
+                self.LogError("Ignoring group cycle: " + " -> ".join(path + [memberId]))
+                groupedIds.remove(memberId)
+            elif memberId not in members:
+                members.append(memberId)
+                self.CollectGroupMembers(memberId, path + [memberId], members)
+
+    #---------------------MyConfig::getTravelProfile----------------------------
+    # Calibration of the travel of a shutter from the section ShutterProfiles,
+    # or linear in both directions over its duration if it isn't calibrated
+    def getTravelProfile(self, shutterId):
+        shutter = self.Shutters[shutterId]
+        profile = shutter.get('profile')
+        if profile == None:
+            value = self.ReadValue(shutterId, section="ShutterProfiles", return_type=str, NoLog=True)
+            profile = None
+            if value != None:
+                try:
+                    profile = TravelProfile.parse(value)
+                except Exception as e1:
+                    self.LogErrorLine("Invalid travel profile for shutter "+shutterId+", assuming linear travel: " + str(e1))
+            if profile == None:
+                profile = TravelProfile(float(shutter['duration']))
+            shutter['profile'] = profile
+        return profile
+
     #---------------------MyConfig::setLocation---------------------------------
     def setLocation(self, lat, lng):
-        self.WriteValue("Latitude", lat, section="General");
-        self.WriteValue("Longitude", lng, section="General");
+        with self.Transaction():
+            self.WriteValue("Latitude", lat, section="General");
+            self.WriteValue("Longitude", lng, section="General");
         self.Latitude = lat
         self.Longitude = lng
 
     #---------------------MyConfig::setCode---------------------------------
+    # The codes are kept in the rolling code journal, the config file is only
+    # updated with the journal content when the config is loaded. Without the
+    # journal the config file is written straight away: a code that has been
+    # sent must never be reused after a crash.
     def setCode(self, shutterId, code):
-        self.WriteValue(hex(int(shutterId,16)), str(code), section="ShutterRollingCodes");
+        if (self.CodeJournal == None) or not self.CodeJournal.Reserve(hex(int(shutterId,16)), code):
+            self.WriteValue(hex(int(shutterId,16)), str(code), section="ShutterRollingCodes");
+            self.Flush()
         self.Shutters[shutterId]['code'] = code
-        
+
 
     #---------------------MyConfig::HasOption-----------------------------------
     def HasOption(self, Entry):
@@ -188,31 +359,26 @@ class MyConfig (MyLog):
             return True
         try:
             with self.CriticalLock:
-                with open(self.FileName, "a") as ConfigFile:
-                    ConfigFile.write("[" + SectionName + "]")
-                    ConfigFile.flush()
-                    ConfigFile.close()
-                    # update the read data that is cached
-                    self.config.read(self.FileName)
+                self.FileLines.append("[" + SectionName + "]")
+                self.config.add_section(SectionName)
+                self.ScheduleFlush()
             return True
         except Exception as e1:
             self.LogErrorLine("Error in WriteSection: " + str(e1))
             return False
 
     #---------------------MyConfig::WriteValue----------------------------------
+    # Update the in-memory model of the conf file. The file itself is written
+    # by Flush, after FlushDelay seconds or at the end of a Transaction.
     def WriteValue(self, Entry, Value, remove = False, section = None):
 
         if section != None:
             self.SetSection(section)
 
-        SectionFound = False
         try:
             with self.CriticalLock:
-                Found = False
-                ConfigFile = open(self.FileName,'r')
-                FileList = ConfigFile.read().splitlines()
-                ConfigFile.close()
-                
+                FileList = self.FileLines
+
                 mySectionStart = -1;
                 mySectionEnd = -1;
                 myLine = -1; 
@@ -234,26 +400,92 @@ class MyConfig (MyLog):
                 if mySectionStart == -1:
                     raise Exception("NOT ABLE TO FIND SECTION:"+self.Section)
 
-                ConfigFile = open(self.FileName,'w')
-                for i, line in enumerate(FileList):
-                    if myLine >= 0 and myLine == i and not remove:      # I found my line, now write new value
-                       ConfigFile.write(Entry + " = " + Value + "\n")
-                    elif myLine == -1 and mySectionEnd == i:            # Here we have to insert the new record...
-                       ConfigFile.write(line+"\n")
-                       ConfigFile.write(Entry + " = " + Value + "\n")
-                    else:                                               # Nothing special, just copy the previous line....
-                       ConfigFile.write(line+"\n")
-
-                ConfigFile.flush()
-                ConfigFile.close()
-                # update the read data that is cached
-                self.config.read(self.FileName)
+                if myLine >= 0 and remove:                          # drop my line
+                    del FileList[myLine]
+                elif myLine >= 0:                                   # I found my line, now write new value
+                    FileList[myLine] = Entry + " = " + Value
+                elif not remove:                                    # Here we have to insert the new record...
+                    FileList.insert(mySectionEnd + 1, Entry + " = " + Value)
+
+                # update the parsed data
+                sectionName = self.GetSectionName(FileList[mySectionStart])
+                if remove:
+                    if self.config.has_section(sectionName):
+                        self.config.remove_option(sectionName, Entry)
+                else:
+                    if not self.config.has_section(sectionName):
+                        self.config.add_section(sectionName)
+                    self.config.set(sectionName, Entry, Value)
+
+                self.ScheduleFlush()
             return True
 
         except Exception as e1:
             self.LogError("Error in WriteValue: " + str(e1))
             return False
 
+    #---------------------MyConfig::Transaction---------------------------------
+    # Group several changes into a single write of the conf file:
+    #    with config.Transaction():
+    #        config.WriteValue(...)
+    #        config.WriteValue(...)
+    @contextmanager
+    def Transaction(self):
+
+        with self.CriticalLock:
+            self.TransactionDepth += 1
+        try:
+            yield self
+        finally:
+            with self.CriticalLock:
+                self.TransactionDepth -= 1
+                if self.TransactionDepth == 0 and self.Dirty:
+                    self.ScheduleFlush()
+
+    #---------------------MyConfig::ScheduleFlush-------------------------------
+    # Called with the CriticalLock held
+    def ScheduleFlush(self):
+
+        if self.ReadOnly:
+            return
+        self.Dirty = True
+        if self.TransactionDepth > 0 or self.FlushTimer != None:
+            return
+        self.FlushTimer = threading.Timer(self.FlushDelay, self.Flush)
+        self.FlushTimer.daemon = True
+        self.FlushTimer.start()
+
+    #---------------------MyConfig::Flush---------------------------------------
+    # Write the conf file if it has changed: to a temporary file first, which
+    # then replaces the conf file, so it is never left half written.
+    def Flush(self):
+
+        with self.FlushLock:
+            with self.CriticalLock:
+                if self.FlushTimer != None:
+                    self.FlushTimer.cancel()
+                    self.FlushTimer = None
+                if not self.Dirty or self.FileName == None:
+                    return True
+                FileList = list(self.FileLines)
+                self.Dirty = False
+
+            try:
+                tmpFileName = self.FileName + ".tmp"
+                with open(tmpFileName, "w") as ConfigFile:
+                    for line in FileList:
+                        ConfigFile.write(line + "\n")
+                    ConfigFile.flush()
+                    os.fsync(ConfigFile.fileno())
+                os.replace(tmpFileName, self.FileName)
+                self.LogDebug("Config file written")
+                return True
+            except Exception as e1:
+                with self.CriticalLock:
+                    self.Dirty = True
+                self.LogError("Error in Flush: " + str(e1))
+                return False
+
     #---------------------MyConfig::GetSectionName------------------------------
     def GetSectionName(self, Line):
 
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import threading
+import itertools
+import traceback
+import collections
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+
+class Subscription(threading.Thread, MyLog):
+    # Delivers the values published for a subscriber on its own thread. The
+    # queue keeps one pending value per shutter: when the subscriber falls
+    # behind, a new value replaces the one it has not consumed yet.
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
+        threading.Thread.__init__(self, group=group, target=target, name=kwargs["name"])
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        self.daemon = True
+
+        self.args = args
+        self.kwargs = kwargs
+        if kwargs["log"] != None:
+            self.log = kwargs["log"]
+        self.callback = kwargs["callback"]
+
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()  # shutterId -> (value, publish time)
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.lastLag = 0.0
+        self.maxLag = 0.0
+        return
+
+    #---------------------Subscription::put-------------------------------------
+    # Never blocks the producer
+    def put(self, shutterId, value):
+        with self.condition:
+            self.published += 1
+            if shutterId in self.pending:
+                del self.pending[shutterId]
+                self.dropped += 1
+            self.pending[shutterId] = (value, time.monotonic())
+            self.condition.notify()
+
+    #---------------------Subscription::getStats--------------------------------
+    def getStats(self):
+        with self.condition:
+            return {'pending': len(self.pending), 'published': self.published, 'delivered': self.delivered,
+                    'dropped': self.dropped, 'failed': self.failed, 'lastLag': self.lastLag, 'maxLag': self.maxLag}
+
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            with self.condition:
+                if len(self.pending) == 0:
+                    self.condition.wait(1)
+                    continue
+                shutterId, (value, publishTime) = self.pending.popitem(last = False)
+
+            try:
+                self.callback(shutterId, value)
+                delivered = True
+            except:
+                self.LogError("Error in subscriber " + self.name + " for " + str(shutterId))
+                self.LogError(traceback.format_exc())
+                delivered = False
+
+            lag = time.monotonic() - publishTime
+            with self.condition:
+                if delivered:
+                    self.delivered += 1
+                else:
+                    self.failed += 1
+                self.lastLag = lag
+                self.maxLag = max(self.maxLag, lag)
+        return
+
+
+class EventBus(MyLog):
+    # Publish/subscribe of the shutter positions and statuses. Every subscriber
+    # gets its own queue and thread, so a slow or failing subscriber only
+    # delays itself.
+    def __init__(self, log = None):
+        super(EventBus, self).__init__()
+        self.log = log
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.sequence = itertools.count(1)
+
+    #---------------------EventBus::subscribe-----------------------------------
+    # Returns the Subscription, whose put() method publishes to the subscriber.
+    # Subscriptions are named "Events-<number>-<name>", unique even if several
+    # callbacks share the same name (lambdas, methods of several instances).
+    def subscribe(self, callback, name = None):
+        if name == None:
+            name = getattr(callback, '__name__', 'subscriber')
+        subscription = Subscription(kwargs={'log': self.log, 'callback': callback, 'name': "Events-" + str(next(self.sequence)) + "-" + name})
+        with self.lock:
+            self.subscriptions.append(subscription)
+        subscription.start()
+        return subscription
+
+    #---------------------EventBus::getStats------------------------------------
+    def getStats(self):
+        with self.lock:
+            return dict((subscription.name, subscription.getStats()) for subscription in self.subscriptions)
+
+    #---------------------EventBus::close---------------------------------------
+    def close(self):
+        with self.lock:
+            for subscription in self.subscriptions:
+                subscription.shutdown_flag.set()
+                with subscription.condition:
+                    subscription.condition.notify()
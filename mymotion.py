@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import heapq
+import itertools
+import threading
+import traceback
+
+try:
+    from mylog import MyLog
+    from myradio import Transmitter
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+
+class TravelProfile(object):
+    # Calibration of the travel of one blind: the duration of a full travel down
+    # and up, and an optional curve of the position vs the time for a full travel
+    # up, as a list of (percentage of the travel time, position) points. The
+    # same curve is followed backwards going down. Both directions of the curve
+    # are sampled into tables so conversions are a lookup and an interpolation.
+    resolution = 1000   # number of time samples
+
+    def __init__(self, durationDown, durationUp = None, curve = None):
+        self.durationDown = float(durationDown)
+        self.durationUp = float(durationUp) if durationUp != None else self.durationDown
+        if (self.durationDown <= 0) or (self.durationUp <= 0):
+            raise ValueError("Travel durations must be positive")
+        if curve == None:
+            curve = [(0.0, 0.0), (100.0, 100.0)]
+        curve = [(float(t), float(p)) for t, p in curve]
+        if (curve[0] != (0.0, 0.0)) or (curve[-1] != (100.0, 100.0)):
+            raise ValueError("Travel curve must start at 0:0 and end at 100:100")
+        for i in range(1, len(curve)):
+            if (curve[i][0] <= curve[i-1][0]) or (curve[i][1] <= curve[i-1][1]):
+                raise ValueError("Travel curve must be strictly increasing")
+        self.curve = curve
+
+        # fraction of the travel time to reach each whole position, going up
+        self.timeTable = [self.interpolate(curve, position, 1, 0) / 100.0 for position in range(0, 101)]
+        # position reached at each time sample, going up
+        self.positionTable = [self.interpolate(curve, 100.0 * i / self.resolution, 0, 1) for i in range(0, self.resolution + 1)]
+
+    #---------------------TravelProfile::parse----------------------------------
+    # Read "<down seconds>,<up seconds>[,<time%>:<position%> ...]"
+    @classmethod
+    def parse(cls, value):
+        param = value.split(",")
+        curve = None
+        if (len(param) > 2) and (param[2].strip() != ""):
+            curve = [point.split(":") for point in param[2].split()]
+        return cls(float(param[0]), float(param[1]) if len(param) > 1 else None, curve)
+
+    # Linear interpolation of the curve, from the column 'x' to the column 'y'
+    @staticmethod
+    def interpolate(curve, value, x, y):
+        for i in range(1, len(curve)):
+            if value <= curve[i][x]:
+                low, high = curve[i-1], curve[i]
+                return low[y] + (high[y] - low[y]) * (value - low[x]) / (high[x] - low[x])
+        return curve[-1][y]
+
+    #---------------------TravelProfile::getTimeFraction------------------------
+    # Fraction of the full travel time needed to go from 0 to 'position'
+    def getTimeFraction(self, position):
+        position = min(100.0, max(0.0, position))
+        index = min(int(position), 99)
+        return self.timeTable[index] + (self.timeTable[index+1] - self.timeTable[index]) * (position - index)
+
+    #---------------------TravelProfile::getPositionAt--------------------------
+    # Position reached going up after 'fraction' of the full travel time
+    def getPositionAt(self, fraction):
+        sample = min(1.0, max(0.0, fraction)) * self.resolution
+        index = min(int(sample), self.resolution - 1)
+        return self.positionTable[index] + (self.positionTable[index+1] - self.positionTable[index]) * (sample - index)
+
+    #---------------------TravelProfile::getDuration----------------------------
+    def getDuration(self, startingPosition, targetPosition):
+        return self.durationUp if targetPosition > startingPosition else self.durationDown
+
+    #---------------------TravelProfile::getTravelTime--------------------------
+    # Seconds needed to go from 'startingPosition' to 'targetPosition'
+    def getTravelTime(self, startingPosition, targetPosition):
+        fraction = abs(self.getTimeFraction(targetPosition) - self.getTimeFraction(startingPosition))
+        return fraction * self.getDuration(startingPosition, targetPosition)
+
+    #---------------------TravelProfile::getPosition----------------------------
+    # Position after moving for 'elapsed' seconds from 'startingPosition' towards 'targetPosition'
+    def getPosition(self, startingPosition, targetPosition, elapsed):
+        if targetPosition == startingPosition:
+            return startingPosition
+        fraction = elapsed / self.getDuration(startingPosition, targetPosition)
+        if targetPosition > startingPosition:
+            return min(targetPosition, self.getPositionAt(self.getTimeFraction(startingPosition) + fraction))
+        return max(targetPosition, self.getPositionAt(self.getTimeFraction(startingPosition) - fraction))
+
+
+class Motion(object):
+    # One movement of a blind, from startingPosition to targetPosition
+    def __init__(self, generation, startingPosition, targetPosition, startTime, duration):
+        self.generation = generation
+        self.startingPosition = startingPosition
+        self.targetPosition = targetPosition
+        self.startTime = startTime
+        self.duration = duration
+        self.publishInterval = None
+
+
+class PositionSubscriber(object):
+    # A position callback and the rate it wants to be updated at while a blind moves
+    def __init__(self, callback, interval = None, minDelta = None):
+        self.callback = callback
+        self.interval = interval
+        self.minDelta = minDelta
+        self.lastTime = {}
+        self.lastPosition = {}
+
+    # 'updates' is the list of (shutterId, position) changed by one update
+    def notify(self, updates, now = None, periodic = False):
+        if now == None:
+            now = time.monotonic()
+        for shutterId, position in updates:
+            if periodic:
+                if self.interval == None:
+                    return
+                # small tolerance, so the timer jitter doesn't make us skip a period
+                if now - self.lastTime.get(shutterId, 0) < self.interval * 0.9:
+                    continue
+                if (self.minDelta != None) and (shutterId in self.lastPosition) and (abs(position - self.lastPosition[shutterId]) < self.minDelta):
+                    continue
+            self.lastTime[shutterId] = now
+            self.lastPosition[shutterId] = position
+            self.callback(shutterId, position)
+
+
+class MotionEngine(threading.Thread, MyLog):
+    # Kind of the timer events
+    eventPublish = 0
+    eventArrival = 1
+
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
+        threading.Thread.__init__(self, group=group, target=target, name="Motion")
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        self.daemon = True
+
+        self.args = args
+        self.kwargs = kwargs
+        if kwargs["log"] != None:
+            self.log = kwargs["log"]
+        self.shutter = kwargs["shutter"]
+        self.config = kwargs["config"]
+
+        self.condition = threading.Condition()
+        self.timers = []            # heap of (time, sequence, shutterId, generation, kind)
+        self.motions = {}           # shutterId -> current Motion
+        self.handling = False       # a timer event is being handled
+        self.sequence = itertools.count()
+        self.generation = itertools.count()
+        return
+
+    #---------------------MotionEngine::move------------------------------------
+    # Track the movement of a blind. Replaces any movement in progress.
+    def move(self, shutterId, startingPosition, targetPosition, startTime = None):
+        if startingPosition == None:
+            startingPosition = self.getAssumedStart(targetPosition)
+        duration = self.config.getTravelProfile(shutterId).getTravelTime(startingPosition, targetPosition)
+        now = time.monotonic() if startTime == None else startTime
+        with self.condition:
+            motion = Motion(next(self.generation), startingPosition, targetPosition, now, duration)
+            self.motions[shutterId] = motion
+            # positions are computed on demand, they are only pushed to the subscribers that asked for updates
+            motion.publishInterval = self.shutter.getPublishInterval()
+            self.scheduleMotion(shutterId, motion)
+        self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Waiting for operation to complete for " + str(duration) + " seconds")
+
+    #---------------------MotionEngine::scheduleMotion--------------------------
+    # Replace the timers of the blind by the ones of 'motion'. Called with the
+    # condition held.
+    def scheduleMotion(self, shutterId, motion):
+        self.unschedule(shutterId)
+        now = motion.startTime
+        if (motion.publishInterval != None) and (motion.duration > 0):
+            # a movement that started in the past (restored, retimed) is published from now on
+            self.schedule(max(now, time.monotonic()), shutterId, motion, self.eventPublish)
+        arrival = now + motion.duration
+        if (motion.targetPosition < 96) and (motion.targetPosition > 4):
+            # send the stop of a partial movement so that it is on air when the target is reached
+            arrival = max(now, arrival - Transmitter.onAirDelay)
+        self.schedule(arrival, shutterId, motion, self.eventArrival)
+        self.condition.notify_all()
+
+    #---------------------MotionEngine::getAssumedStart-------------------------
+    # Starting position of a blind whose position is unknown: the far end, so
+    # the blind is sure to have arrived when the movement is complete
+    @staticmethod
+    def getAssumedStart(targetPosition):
+        return 100 if targetPosition < 50 else 0
+
+    #---------------------MotionEngine::retime----------------------------------
+    # Move the start of the movement started at 'startTime' to 'newStartTime'.
+    # Returns False if that movement is not tracked anymore.
+    def retime(self, shutterId, startTime, newStartTime):
+        with self.condition:
+            motion = self.motions.get(shutterId)
+            if (motion == None) or (motion.startTime != startTime):
+                return False
+            motion.startTime = newStartTime
+            self.scheduleMotion(shutterId, motion)
+            return True
+
+    #---------------------MotionEngine::updatePublishing-----------------------
+    # Apply a new publish interval (a position subscriber registered) to the
+    # movements in progress, e.g. the ones restored at startup
+    def updatePublishing(self):
+        interval = self.shutter.getPublishInterval()
+        with self.condition:
+            for shutterId, motion in self.motions.items():
+                if motion.publishInterval != interval:
+                    motion.publishInterval = interval
+                    self.scheduleMotion(shutterId, motion)
+
+    #---------------------MotionEngine::cancel----------------------------------
+    # Forget the movement in progress and its timers
+    def cancel(self, shutterId):
+        with self.condition:
+            motion = self.motions.pop(shutterId, None)
+            if motion != None:
+                self.unschedule(shutterId)
+                self.condition.notify_all()
+            return motion
+
+    #---------------------MotionEngine::isMoving--------------------------------
+    def isMoving(self, shutterId):
+        with self.condition:
+            return shutterId in self.motions
+
+    #---------------------MotionEngine::waitIdle--------------------------------
+    # Block until no movement is tracked anymore and the arrival of the last one
+    # has been handled (e.g. the STOP of a partial movement submitted)
+    def waitIdle(self):
+        with self.condition:
+            while ((len(self.motions) > 0) or self.handling) and not self.shutdown_flag.is_set():
+                self.condition.wait()
+
+    #---------------------MotionEngine::shutdown--------------------------------
+    def shutdown(self):
+        with self.condition:
+            self.shutdown_flag.set()
+            self.condition.notify_all()
+
+    #---------------------MotionEngine::schedule--------------------------------
+    # Called with the condition held
+    def schedule(self, when, shutterId, motion, kind):
+        heapq.heappush(self.timers, (when, next(self.sequence), shutterId, motion.generation, kind))
+
+    #---------------------MotionEngine::unschedule------------------------------
+    # Drop the timers of a blind. Called with the condition held.
+    def unschedule(self, shutterId):
+        timers = [timer for timer in self.timers if timer[2] != shutterId]
+        if len(timers) != len(self.timers):
+            heapq.heapify(timers)
+            self.timers = timers
+
+    #---------------------MotionEngine::nextEvent-------------------------------
+    # Wait for the next timer. Any change of the timers notifies the condition,
+    # so there is no need to wake up in between.
+    def nextEvent(self):
+        with self.condition:
+            while not self.shutdown_flag.is_set():
+                if len(self.timers) == 0:
+                    self.condition.wait()
+                    continue
+                when, sequence, shutterId, generation, kind = self.timers[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.timers)
+                motion = self.motions.get(shutterId)
+                if (motion == None) or (motion.generation != generation):
+                    continue    # cancelled or replaced
+                if kind == self.eventArrival:
+                    del self.motions[shutterId]
+                elif when + motion.publishInterval < motion.startTime + motion.duration:
+                    self.schedule(when + motion.publishInterval, shutterId, motion, self.eventPublish)
+                self.handling = True
+                return shutterId, motion, kind, when
+        return None
+
+    def run(self):
+        self.LogInfo("Entering motion engine loop")
+        while not self.shutdown_flag.is_set():
+            event = self.nextEvent()
+            if event == None:
+                continue
+            shutterId, motion, kind, when = event
+            try:
+                if kind == self.eventPublish:
+                    self.shutter.publishPosition(shutterId)
+                else:
+                    self.shutter.motionComplete(shutterId, motion.targetPosition)
+            except:
+                self.LogError("Error in motion engine for " + str(shutterId))
+                self.LogError(traceback.format_exc())
+            with self.condition:
+                self.handling = False
+                self.condition.notify_all()
+
+        self.LogError("Received Signal to shut down Motion thread")
+        return
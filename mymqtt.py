@@ -8,7 +8,6 @@ import os
 import re
 import time
 import locale
-import pigpio
 import socket
 import signal, atexit, subprocess, traceback
 import threading
@@ -181,7 +180,7 @@ class MQTT(threading.Thread, MyLog):
         self.t.on_connect = self.on_connect
         self.t.on_message = self.receiveMessageFromMQTT
         self.t.on_disconnect = self.on_disconnect
-        self.shutter.registerPositionCallBack(self.set_position)
+        self.shutter.registerPositionCallBack(self.set_position, interval = 0.25, minDelta = self.config.MQTT_PositionDelta)
         self.shutter.registerStateCallBack(self.set_state)
         
         # Startup the mqtt listener
@@ -0,0 +1,866 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import atexit
+import struct
+import threading
+import itertools
+import collections
+import bisect
+
+try:
+    import pigpio
+except ImportError:
+    pigpio = None   # only needed by the pigpio radio backend
+
+import heapq
+from concurrent.futures import Future
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+
+class FrameEncoder(object):
+    # Lookup tables shared by all the encoders:
+    #  - checksumTable[b] is the contribution of octet b to the frame checksum
+    #  - symbolTable[b] are the 8 bits of octet b, most significant bit first
+    checksumTable = tuple((b ^ (b >> 4)) & 0xF for b in range(256))
+    symbolTable = tuple(tuple((b >> (7 - i)) & 1 for i in range(8)) for b in range(256))
+    key = 0xA7          # Encryption key. Doesn't matter much
+
+    #---------------------FrameEncoder::encode----------------------------------
+    # Return the obfuscated 7 octets frame for a command
+    @classmethod
+    def encode(cls, address, button, code):
+        T = cls.checksumTable
+        f0 = cls.key
+        f1 = (button & 0xF) << 4           # The 4 LSB will be the checksum
+        f2 = (code >> 8) & 0xFF            # Rolling code (big endian)
+        f3 = code & 0xFF
+        f4 = (address >> 16) & 0xFF        # Remote address
+        f5 = (address >> 8) & 0xFF
+        f6 = address & 0xFF
+        f1 |= T[f0] ^ T[f1] ^ T[f2] ^ T[f3] ^ T[f4] ^ T[f5] ^ T[f6]
+
+        # obfuscation: every octet is xored with the previous (obfuscated) one
+        f1 ^= f0
+        f2 ^= f1
+        f3 ^= f2
+        f4 ^= f3
+        f5 ^= f4
+        f6 ^= f5
+        return bytearray((f0, f1, f2, f3, f4, f5, f6))
+
+    #---------------------FrameEncoder::symbols---------------------------------
+    # Return the 56 bits of a frame, in the order they are transmitted
+    @classmethod
+    def symbols(cls, frame):
+        S = cls.symbolTable
+        return S[frame[0]] + S[frame[1]] + S[frame[2]] + S[frame[3]] + S[frame[4]] + S[frame[5]] + S[frame[6]]
+
+    #---------------------FrameEncoder::encodeBatch-----------------------------
+    # Encode many (address, button, rolling code) commands in one pass. Returns
+    # the list of frames and the list of their bits.
+    @classmethod
+    def encodeBatch(cls, commands):
+        encode = cls.encode
+        symbols = cls.symbols
+        frames = [encode(address, button, code) for address, button, code in commands]
+        return frames, [symbols(frame) for frame in frames]
+
+
+class WaveCompiler(MyLog):
+    # Somfy RTS timings in microseconds
+    wakeUpHigh = 9415
+    wakeUpLow = 89565
+    hwSyncHalf = 2560
+    swSyncHigh = 4550
+    swSyncLow = 640
+    symbolHalf = 640
+    interFrameGap = 30415
+
+    # number of hardware synchronization pulses in the first frame and in the repetitions
+    hwSyncFirst = 2
+    hwSyncRepeat = 7
+
+    #---------------------WaveCompiler::__init__--------------------------------
+    def __init__(self, txgpio, log = None):
+        super(WaveCompiler, self).__init__()
+        if log != None:
+            self.log = log
+        self.TXGPIO = txgpio
+        self.waves = None
+
+    #---------------------WaveCompiler::segments--------------------------------
+    # The fixed segments of a frame as lists of (level, duration) pulses
+    @classmethod
+    def segments(cls):
+        return {
+            'wakeUp': [(1, cls.wakeUpHigh), (0, cls.wakeUpLow)],
+            'hwSync': [(1, cls.hwSyncHalf), (0, cls.hwSyncHalf)],
+            'swSync': [(1, cls.swSyncHigh), (0, cls.swSyncLow)],
+            'bit0':   [(1, cls.symbolHalf), (0, cls.symbolHalf)],
+            'bit1':   [(0, cls.symbolHalf), (1, cls.symbolHalf)],
+            'gap':    [(0, cls.interFrameGap)],
+        }
+
+    #---------------------WaveCompiler::pulseTrain------------------------------
+    # The (level, duration) pulses of the transmission that buildChain describes
+    @classmethod
+    def pulseTrain(cls, frame, repetition, first = True):
+        seg = cls.segments()
+        bitPulses = (seg['bit0'], seg['bit1'])
+        payload = []
+        for bit in FrameEncoder.symbols(frame):
+            payload += bitPulses[bit]
+
+        pulses = []
+        repeats = repetition
+        if first:
+            pulses += seg['wakeUp'] + seg['hwSync'] * cls.hwSyncFirst + seg['swSync'] + payload + seg['gap']
+            repeats -= 1
+        if repeats > 0:
+            pulses += (seg['hwSync'] * cls.hwSyncRepeat + seg['swSync'] + payload + seg['gap']) * repeats
+        return pulses
+
+    #---------------------WaveCompiler::isCompiled------------------------------
+    def isCompiled(self):
+        return self.waves != None
+
+    #---------------------WaveCompiler::compile---------------------------------
+    # Upload the fixed segments of a Somfy frame to the pigpio daemon once. The
+    # segments are then referenced by their wave ID in every chain we transmit.
+    def compile(self, pi):
+        mask = 1 << self.TXGPIO
+
+        self.release(pi)
+        waves = {}
+        pi.wave_add_new()
+        for name, pulses in self.segments().items():
+            pi.wave_add_generic([pigpio.pulse(mask, 0, duration) if level else pigpio.pulse(0, mask, duration) for level, duration in pulses])
+            waves[name] = pi.wave_create()
+            if waves[name] < 0:
+                raise Exception("Unable to create wave segment " + name + ": " + str(waves[name]))
+        self.waves = waves
+        self.LogDebug("Compiled wave segments: " + str(waves))
+
+    #---------------------WaveCompiler::release---------------------------------
+    def release(self, pi):
+        if self.waves != None:
+            try:
+                for wid in self.waves.values():
+                    pi.wave_delete(wid)
+            except Exception as e1:
+                self.LogDebug("Unable to release wave segments: " + str(e1))
+        self.waves = None
+
+    #---------------------WaveCompiler::buildChain------------------------------
+    # Build the wave_chain for a frame sent once, followed by 'repetition - 1'
+    # repeated frames. Only the 56 payload symbols are frame specific, the
+    # repetitions are expressed as pigpio loops. With first = False all the
+    # frames are sent as repetitions, to continue a press that was interrupted.
+    def buildChain(self, frame, repetition, first = True):
+        w = self.waves
+        bitWaves = (w['bit0'], w['bit1'])
+        payload = [bitWaves[bit] for bit in FrameEncoder.symbols(frame)]
+
+        chain = []
+        repeats = repetition
+        if first:
+            chain += [w['wakeUp']]
+            chain += [255, 0, w['hwSync'], 255, 1, self.hwSyncFirst, 0]
+            chain += [w['swSync']] + payload + [w['gap']]
+            repeats -= 1
+
+        if repeats > 0:
+            chain += [255, 0]
+            chain += [255, 0, w['hwSync'], 255, 1, self.hwSyncRepeat, 0]
+            chain += [w['swSync']] + payload + [w['gap']]
+            chain += [255, 1, repeats & 0xFF, repeats >> 8]
+        return chain
+
+    #---------------------WaveCompiler::frameDuration---------------------------
+    # Duration of the first frame (including the wake up pulse) or of a repeated
+    # frame in microseconds
+    @classmethod
+    def frameDuration(cls, first = True):
+        payload = cls.swSyncHigh + cls.swSyncLow + 56 * 2 * cls.symbolHalf + cls.interFrameGap
+        if first:
+            return cls.wakeUpHigh + cls.wakeUpLow + cls.hwSyncFirst * 2 * cls.hwSyncHalf + payload
+        return cls.hwSyncRepeat * 2 * cls.hwSyncHalf + payload
+
+    #---------------------WaveCompiler::chainDuration---------------------------
+    # Duration of a full transmission of 'repetition' frames in seconds
+    @classmethod
+    def chainDuration(cls, repetition, first = True):
+        if first:
+            return (cls.frameDuration(True) + max(repetition - 1, 0) * cls.frameDuration(False)) / 1000000.0
+        return repetition * cls.frameDuration(False) / 1000000.0
+
+    #---------------------WaveCompiler::send------------------------------------
+    def send(self, pi, frame, repetition, first = True):
+        if not self.isCompiled():
+            self.compile(pi)
+        return pi.wave_chain(self.buildChain(frame, repetition, first))
+
+
+class RadioBackend(MyLog):
+    #---------------------RadioBackend::__init__--------------------------------
+    # Interface of the RF transmitters used by the Transmitter thread
+    def __init__(self, log = None):
+        super(RadioBackend, self).__init__()
+        if log != None:
+            self.log = log
+        self.txEndTime = 0           # expected end of the current transmission (time.monotonic())
+
+    #---------------------RadioBackend::connect---------------------------------
+    def connect(self):
+        return True
+
+    #---------------------RadioBackend::close-----------------------------------
+    def close(self):
+        pass
+
+    #---------------------RadioBackend::send------------------------------------
+    # Transmit a frame followed by 'repetition - 1' repeated frames and return
+    # once the transmission is complete.
+    def send(self, frame, repetition, first = True):
+        raise NotImplementedError()
+
+    #---------------------RadioBackend::getTxEndTime----------------------------
+    def getTxEndTime(self):
+        return self.txEndTime
+
+    #---------------------RadioBackend::getHealth-------------------------------
+    def getHealth(self):
+        return {}
+
+
+class PigpioConnection(RadioBackend):
+    #---------------------PigpioConnection::__init__----------------------------
+    # Long-lived connection to the pigpio daemon. The GPIO is configured and the
+    # wave segments are compiled once per connection. If pigpiod goes away the
+    # connection is re-established on the next transmission.
+    # pigpiod keeps the waves until they are deleted, whoever created them: the
+    # wave IDs are recorded in 'waveFile', so the ones left by a process that
+    # didn't exit cleanly are deleted by the next connection.
+    connectionErrors = (pigpio.error, OSError, struct.error) if pigpio != None else (OSError, struct.error)
+
+    def __init__(self, txgpio, log = None, waveFile = None):
+        super(PigpioConnection, self).__init__(log = log)
+        if pigpio == None:
+            raise Exception("The pigpio radio requires the pigpio library")
+        self.TXGPIO = txgpio
+        self.waveFile = waveFile
+        self.lock = threading.Lock()
+        self.pi = None
+        self.compiler = WaveCompiler(txgpio, log = self.log)
+        atexit.register(self.close)
+
+        # health counters
+        self.connects = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.framesSent = 0
+        self.lastError = None
+        self.lastConnectTime = None
+        self.lateCompletions = 0
+
+    #---------------------PigpioConnection::isConnected-------------------------
+    def isConnected(self):
+        return (self.pi != None) and self.pi.connected
+
+    #---------------------PigpioConnection::connect-----------------------------
+    def connect(self):
+        with self.lock:
+            return self._connect()
+
+    def _connect(self):
+        if self.isConnected():
+            return True
+
+        if self.pi != None:
+            self._drop()
+
+        pi = pigpio.pi()
+        if not pi.connected:
+            self.failures += 1
+            self.lastError = "Unable to connect to pigpiod"
+            self.LogError(self.lastError)
+            return False
+
+        try:
+            pi.set_mode(self.TXGPIO, pigpio.OUTPUT)
+            # Wave IDs don't survive a restart of the daemon, so compile them for every new connection
+            self.compiler.waves = None
+            self.releaseStaleWaves(pi)
+            self.compiler.compile(pi)
+            self.saveWaves()
+        except Exception as e1:
+            self.failures += 1
+            self.lastError = str(e1)
+            self.LogError("Unable to setup pigpio connection: " + str(e1))
+            pi.stop()
+            return False
+
+        self.pi = pi
+        if self.connects > 0:
+            self.reconnects += 1
+        self.connects += 1
+        self.lastConnectTime = time.time()
+        self.LogInfo("Connected to pigpiod (GPIO " + str(self.TXGPIO) + ")")
+        return True
+
+    #---------------------PigpioConnection::releaseStaleWaves-------------------
+    # Delete the waves recorded by a previous connection that was not closed
+    def releaseStaleWaves(self, pi):
+        if (self.waveFile == None) or not os.path.isfile(self.waveFile):
+            return
+        try:
+            with open(self.waveFile, "r") as WaveFile:
+                waves = [int(wid) for wid in WaveFile.read().split()]
+            for wid in waves:
+                try:
+                    pi.wave_delete(wid)
+                except pigpio.error:
+                    pass    # already gone, e.g. the daemon restarted
+            self.LogInfo("Deleted " + str(len(waves)) + " wave segments left on pigpiod")
+            os.remove(self.waveFile)
+        except Exception as e1:
+            self.LogError("Error in PigpioConnection:releaseStaleWaves: " + str(e1))
+
+    #---------------------PigpioConnection::saveWaves---------------------------
+    def saveWaves(self):
+        if self.waveFile == None:
+            return
+        try:
+            with open(self.waveFile, "w") as WaveFile:
+                WaveFile.write(" ".join(str(wid) for wid in self.compiler.waves.values()) + "\n")
+        except Exception as e1:
+            self.LogError("Error in PigpioConnection:saveWaves: " + str(e1))
+
+    #---------------------PigpioConnection::_drop-------------------------------
+    def _drop(self):
+        try:
+            self.pi.stop()
+        except Exception:
+            pass
+        self.pi = None
+
+    #---------------------PigpioConnection::close-------------------------------
+    # Also called at exit, so the waves are released whatever the way out
+    def close(self):
+        with self.lock:
+            if self.isConnected() and self.compiler.isCompiled():
+                self.compiler.release(self.pi)
+                if (self.waveFile != None) and os.path.isfile(self.waveFile):
+                    os.remove(self.waveFile)
+            if self.pi != None:
+                self._drop()
+
+    #---------------------PigpioConnection::send--------------------------------
+    # A broken connection is re-established and the frame is sent again once.
+    # Once the wave is started the frame is on air: an error while waiting for
+    # its end only drops the connection, as sending it again would use up
+    # another rolling code.
+    def send(self, frame, repetition, first = True):
+        with self.lock:
+            for attempt in range(2):
+                if not self._connect():
+                    raise Exception("pigpiod is not available: " + str(self.lastError))
+                try:
+                    self.compiler.send(self.pi, frame, repetition, first)
+                    break
+                except self.connectionErrors as e1:
+                    self.connectionLost(e1)
+            else:
+                raise Exception("Unable to transmit frame: " + str(self.lastError))
+
+            self.txEndTime = time.monotonic() + self.compiler.chainDuration(repetition, first)
+            self.framesSent += repetition
+            try:
+                self.waitForCompletion()
+            except self.connectionErrors as e1:
+                self.connectionLost(e1)
+
+    #---------------------PigpioConnection::connectionLost----------------------
+    # A daemon that restarted leaves a stale socket: its replies come back empty
+    # and pigpio fails to unpack them (struct.error). Called with the lock held.
+    def connectionLost(self, error):
+        self.failures += 1
+        self.lastError = str(error)
+        self.LogError("Error while transmitting, reconnecting to pigpiod: " + str(error))
+        self._drop()
+
+    #---------------------PigpioConnection::waitForCompletion-------------------
+    # The length of the wave is known, so sleep until it should be done and only
+    # then confirm with a few polls of the daemon, instead of spinning on
+    # wave_tx_busy for the whole transmission.
+    def waitForCompletion(self, polls = 10, pollInterval = 0.005, timeout = 1.0):
+        remaining = self.txEndTime - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+        for i in range(polls):
+            if not self.pi.wave_tx_busy():
+                return
+            time.sleep(pollInterval)
+
+        self.lateCompletions += 1
+        deadline = time.monotonic() + timeout
+        while self.pi.wave_tx_busy():
+            if time.monotonic() > deadline:
+                self.LogWarn("Transmission did not complete in time, stopping wave")
+                self.pi.wave_tx_stop()
+                return
+            time.sleep(pollInterval)
+
+    #---------------------PigpioConnection::getHealth---------------------------
+    def getHealth(self):
+        return {'connected': self.isConnected(), 'connects': self.connects, 'reconnects': self.reconnects,
+                'failures': self.failures, 'framesSent': self.framesSent, 'lastError': self.lastError,
+                'lastConnectTime': self.lastConnectTime, 'lateCompletions': self.lateCompletions}
+
+
+class SimulatedRadio(RadioBackend):
+    #---------------------SimulatedRadio::__init__------------------------------
+    # Radio backend that doesn't need any hardware. The pulse trains are built
+    # the same way as on the real transmitter, decoded back into frames and
+    # recorded. The transmission time is modelled by sleeping for the duration
+    # of the wave multiplied by 'timeScale' (0 to not wait at all).
+    def __init__(self, timeScale = 1.0, history = 1000, log = None):
+        super(SimulatedRadio, self).__init__(log = log)
+        self.timeScale = timeScale
+        self.lock = threading.Lock()
+        self.transmissions = collections.deque(maxlen = history)
+        self.framesSent = 0
+        self.pulsesSent = 0
+        self.decodeErrors = 0
+        self.airTime = 0.0
+
+    #---------------------SimulatedRadio::send----------------------------------
+    def send(self, frame, repetition, first = True):
+        with self.lock:
+            pulses = WaveCompiler.pulseTrain(frame, repetition, first)
+            duration = WaveCompiler.chainDuration(repetition, first)
+            startTime = time.monotonic()
+            self.txEndTime = startTime + duration * self.timeScale
+
+            decoded = self.decode(pulses)
+            if len(decoded) != repetition:
+                self.decodeErrors += 1
+                self.LogError("Simulated radio decoded " + str(len(decoded)) + " frames instead of " + str(repetition))
+            self.transmissions.append({'time': startTime, 'duration': duration, 'pulses': len(pulses), 'first': first, 'frames': decoded})
+            self.framesSent += repetition
+            self.pulsesSent += len(pulses)
+            self.airTime += duration
+
+            if self.timeScale > 0:
+                time.sleep(duration * self.timeScale)
+
+    #---------------------SimulatedRadio::decode--------------------------------
+    # Decode a pulse train into a list of (address, button, rolling code) frames
+    @staticmethod
+    def decode(pulses):
+        half = WaveCompiler.symbolHalf
+        tolerance = half // 4
+
+        # merge consecutive pulses of the same level
+        runs = []
+        for level, duration in pulses:
+            if runs and runs[-1][0] == level:
+                runs[-1][1] += duration
+            else:
+                runs.append([level, duration])
+
+        frames = []
+        i = 0
+        while i < len(runs):
+            level, duration = runs[i]
+            i += 1
+            if not (level and abs(duration - WaveCompiler.swSyncHigh) <= tolerance):
+                continue
+
+            # read the 112 half symbols following the software synchronization
+            slots = []
+            skip = 1    # the low part of the software synchronization
+            while (i < len(runs)) and (len(slots) < 112):
+                level, duration = runs[i]
+                count = int(round(float(duration) / half)) - skip
+                skip = 0
+                slots += [level] * max(0, min(count, 112 - len(slots)))
+                if len(slots) < 112:
+                    i += 1
+            if len(slots) < 112:
+                break
+
+            data = bytearray(7)
+            for bit in range(56):
+                if slots[2 * bit] == slots[2 * bit + 1]:
+                    data = None
+                    break
+                if slots[2 * bit + 1]:
+                    data[bit // 8] |= 0x80 >> (bit % 8)
+            if data == None:
+                continue
+
+            # remove the obfuscation and check the checksum
+            clear = bytearray(7)
+            clear[0] = data[0]
+            for n in range(1, 7):
+                clear[n] = data[n] ^ data[n-1]
+            checksum = 0
+            for n in range(7):
+                octet = clear[n] & 0xF0 if n == 1 else clear[n]
+                checksum = checksum ^ octet ^ (octet >> 4)
+            if (checksum & 0xF) != (clear[1] & 0xF):
+                continue
+
+            frames.append(((clear[4] << 16) | (clear[5] << 8) | clear[6], clear[1] >> 4, (clear[2] << 8) | clear[3]))
+        return frames
+
+    #---------------------SimulatedRadio::getHealth-----------------------------
+    def getHealth(self):
+        return {'connected': True, 'framesSent': self.framesSent, 'pulsesSent': self.pulsesSent,
+                'decodeErrors': self.decodeErrors, 'airTime': self.airTime}
+
+
+#---------------------createRadio----------------------------------------------
+def createRadio(config, txgpio, log = None):
+    if config.Radio == "simulated":
+        return SimulatedRadio(timeScale = config.SimulatedTimeScale, log = log)
+    elif config.Radio == "pigpio":
+        return PigpioConnection(txgpio, log = log, waveFile = config.FileName + ".waves" if config.FileName != None else None)
+    raise Exception("Unknown radio backend: " + str(config.Radio))
+
+
+class TransmitJob(object):
+    #---------------------TransmitJob::__init__---------------------------------
+    def __init__(self, shutterId, button, repetition, priority, sequence):
+        self.shutterId = shutterId
+        self.button = button
+        self.repetition = repetition
+        self.priority = priority
+        self.sequence = sequence
+        self.submitTime = time.monotonic()
+        self.startTime = None
+        self.onAirTime = None
+        self.frame = None
+        self.code = None
+        self.sentFrames = 0
+        self.cancelledFrames = 0   # frames dropped because a later command for the same shutter was sent
+        self.future = Future()
+
+    def __lt__(self, other):
+        return False
+
+
+class FrameBudget(object):
+    # Books the air time of a transmitter for the commands planned ahead: a
+    # command of n frames takes n / budget seconds, in which no other planned
+    # command is sent. The booked slots are kept sorted, so a command planned
+    # later can still take a free slot before the ones already booked.
+    def __init__(self, budget):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.slots = []         # sorted (start, end) of the booked slots (time.monotonic())
+
+    #---------------------FrameBudget::book-------------------------------------
+    # Returns the time, 'when' at the earliest, at which 'frames' frames can be sent
+    def book(self, when, frames):
+        if self.budget <= 0:
+            return when
+        duration = frames / self.budget
+        with self.lock:
+            now = time.monotonic()
+            while (len(self.slots) > 0) and (self.slots[0][1] <= now):
+                self.slots.pop(0)
+            for start, end in self.slots:
+                if start >= when + duration:
+                    break
+                if end > when:
+                    when = end
+            bisect.insort(self.slots, (when, when + duration))
+            return when
+
+
+class Transmitter(threading.Thread, MyLog):
+    # Lower values are sent first
+    priorityStop = 0
+    priorityMove = 5
+    priorityRepeat = 6
+    priorityPress = 7
+
+    # A receiver acts on a command once the whole first frame has been received
+    onAirDelay = WaveCompiler.frameDuration(True) / 1000000.0
+
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
+        threading.Thread.__init__(self, group=group, target=target, name="Transmitter")
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        self.daemon = True
+
+        self.args = args
+        self.kwargs = kwargs
+        if kwargs["log"] != None:
+            self.log = kwargs["log"]
+        self.config = kwargs["config"]
+        self.radio = kwargs["radio"]
+
+        self.condition = threading.Condition()
+        self.jobs = []              # heap of (priority, sequence, TransmitJob) waiting to be sent
+        self.unfinished = 0         # jobs submitted and not complete yet, the preempted ones included
+        self.frameBudget = FrameBudget(self.config.TXFrameBudget)
+        self.sequence = itertools.count()
+        self.statsLock = threading.Lock()
+        self.submitted = 0
+        self.rejected = 0
+        self.sent = 0
+        self.failed = 0
+        self.preempted = 0
+        self.truncated = 0
+        self.lastStarted = {}       # shutterId -> sequence of the last job started for that shutter
+        self.maxStopLatency = 0.0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.lastWait = 0.0
+        return
+
+    #---------------------Transmitter::submit-----------------------------------
+    # Queue a command for transmission. Returns a Future straight away, which
+    # completes once the frames have been sent.
+    def submit(self, shutterId, button, repetition, priority = priorityMove):
+        job = TransmitJob(shutterId, button, repetition, priority, next(self.sequence))
+        with self.condition:
+            accepted = not self.isFull()
+            if accepted:
+                heapq.heappush(self.jobs, (priority, job.sequence, job))
+                self.unfinished += 1
+                self.condition.notify_all()
+        if accepted:
+            with self.statsLock:
+                self.submitted += 1
+        else:
+            with self.statsLock:
+                self.rejected += 1
+            self.LogError("Transmit queue is full, dropping command for "+shutterId)
+            job.future.set_exception(Exception("Transmit queue is full"))
+        return job.future
+
+    #---------------------Transmitter::isFull-----------------------------------
+    # Called with the condition held. A TXQueueSize of 0 or less means no limit.
+    def isFull(self):
+        return (self.config.TXQueueSize > 0) and (len(self.jobs) >= self.config.TXQueueSize)
+
+    #---------------------Transmitter::estimateOnAirTime-----------------------
+    # Best guess of when a command submitted now will be acted upon, before the
+    # transmitter actually sends it
+    def estimateOnAirTime(self):
+        return time.monotonic() + self.onAirDelay
+
+    #---------------------Transmitter::flush------------------------------------
+    # Block until every queued command has been transmitted
+    def flush(self):
+        with self.condition:
+            while (self.unfinished > 0) and not self.shutdown_flag.is_set():
+                self.condition.wait()
+
+    #---------------------Transmitter::shutdown---------------------------------
+    def shutdown(self):
+        with self.condition:
+            self.shutdown_flag.set()
+            self.condition.notify_all()
+
+    #---------------------Transmitter::nextJob----------------------------------
+    # Wait for the job with the highest priority, None on shutdown
+    def nextJob(self):
+        with self.condition:
+            while not self.shutdown_flag.is_set():
+                if len(self.jobs) > 0:
+                    return heapq.heappop(self.jobs)[2]
+                self.condition.wait()
+        return None
+
+    #---------------------Transmitter::jobDone----------------------------------
+    def jobDone(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    #---------------------Transmitter::buildFrame-------------------------------
+    def buildFrame(self, shutterId, button):
+        teleco = int(shutterId, 16)
+        code = int(self.config.Shutters[shutterId]['code'])
+        self.config.setCode(shutterId, code+1)
+
+        self.LogInfo ("Remote  :      " + "0x%0.2X" % teleco + ' (' + self.config.Shutters[shutterId]['name'] + ')')
+        self.LogInfo ("Button  :      " + "0x%0.2X" % button)
+        self.LogInfo ("Rolling code : " + str(code))
+
+        frame = FrameEncoder.encode(teleco, button, code)
+
+        outstring = "Obfuscated :"
+        for octet in frame:
+           outstring = outstring + "0x%0.2X" % octet + ' '
+        self.LogInfo (outstring)
+        return frame, code
+
+    #---------------------Transmitter::transmit---------------------------------
+    # Ordinary commands are sent in one go. Long presses are sent in chunks of
+    # TXChunkFrames frames: between two chunks a queued job with a higher
+    # priority preempts the current one, which is put back in the queue and
+    # resumes with repeated frames afterwards, unless a command for the same
+    # shutter has been sent in between (the rest of the frames would cancel it).
+    # Returns True once the job is complete.
+    def transmit(self, job):
+        if job.frame == None:
+            job.startTime = time.monotonic()
+            wait = job.startTime - job.submitTime
+            with self.statsLock:
+                self.totalWait += wait
+                self.maxWait = max(self.maxWait, wait)
+                self.lastWait = wait
+                if job.priority == self.priorityStop:
+                    self.maxStopLatency = max(self.maxStopLatency, wait)
+            self.lastStarted[job.shutterId] = job.sequence
+            job.frame, job.code = self.buildFrame(job.shutterId, job.button)
+        elif self.lastStarted.get(job.shutterId, job.sequence) != job.sequence:
+            self.truncate(job)
+            return True
+
+        while job.sentFrames < job.repetition:
+            count = job.repetition - job.sentFrames
+            if (job.priority == self.priorityPress) and (self.config.TXChunkFrames > 0):
+                count = min(count, self.config.TXChunkFrames)
+            if job.sentFrames == 0:
+                job.onAirTime = time.monotonic() + self.onAirDelay
+            self.radio.send(job.frame, count, job.sentFrames == 0)
+            job.sentFrames += count
+            if (job.sentFrames < job.repetition) and self.preempt(job):
+                return False
+        return True
+
+    #---------------------Transmitter::truncate---------------------------------
+    # Drop the frames of a job that are not sent yet
+    def truncate(self, job):
+        job.cancelledFrames = job.repetition - job.sentFrames
+        job.repetition = job.sentFrames
+        with self.statsLock:
+            self.truncated += 1
+        self.LogDebug("Command for " + job.shutterId + " cancelled after " + str(job.sentFrames) + " frames, a later command for the same shutter was sent")
+
+    #---------------------Transmitter::preempt----------------------------------
+    def preempt(self, job):
+        with self.condition:
+            if (len(self.jobs) == 0) or (self.jobs[0][0] >= job.priority):
+                return False
+            preempting = self.jobs[0][2]
+            if (preempting.shutterId != job.shutterId) and not self.isFull():
+                heapq.heappush(self.jobs, (job.priority, job.sequence, job))
+                preempting = None
+        if preempting != None:
+            if preempting.shutterId == job.shutterId:
+                # e.g. the STOP of the blind receiving a long press
+                self.truncate(job)
+            return False
+        with self.statsLock:
+            self.preempted += 1
+        self.LogDebug("Command for " + job.shutterId + " interrupted after " + str(job.sentFrames) + " of " + str(job.repetition) + " frames")
+        return True
+
+    #---------------------Transmitter::result-----------------------------------
+    def result(self, job):
+        return {'shutterId': job.shutterId, 'button': job.button, 'code': job.code, 'submitTime': job.submitTime,
+                'sentFrames': job.sentFrames, 'cancelledFrames': job.cancelledFrames,
+                'startTime': job.startTime, 'onAirTime': job.onAirTime, 'endTime': time.monotonic()}
+
+    #---------------------Transmitter::getStats---------------------------------
+    def getStats(self):
+        with self.statsLock:
+            done = self.sent + self.failed
+            return {'queueDepth': len(self.jobs), 'submitted': self.submitted, 'rejected': self.rejected,
+                    'sent': self.sent, 'failed': self.failed, 'preempted': self.preempted, 'truncated': self.truncated, 'maxStopLatency': self.maxStopLatency,
+                    'maxWait': self.maxWait, 'lastWait': self.lastWait,
+                    'averageWait': (self.totalWait / done) if done else 0.0}
+
+    def run(self):
+        self.LogInfo("Entering transmitter loop")
+        while not self.shutdown_flag.is_set():
+            job = self.nextJob()
+            if job == None:
+                continue
+
+            done = True     # a preempted job is back in the heap, not done yet
+            try:
+                if (job.frame == None) and not job.future.set_running_or_notify_cancel():
+                    continue
+                done = self.transmit(job)
+                if done:
+                    with self.statsLock:
+                        self.sent += 1
+                    job.future.set_result(self.result(job))
+            except Exception as e1:
+                with self.statsLock:
+                    self.failed += 1
+                self.LogError("Error transmitting command for " + job.shutterId + ": " + str(e1))
+                job.future.set_exception(e1)
+            finally:
+                if done:
+                    self.jobDone()
+
+        self.LogError("Received Signal to shut down Transmitter thread")
+        return
+
+
+#---------------------benchmarkEncoder-----------------------------------------
+# Compare the frame encoding of the original per-bit loops with FrameEncoder
+def benchmarkEncoder(count = 20000):
+    commands = [(0x279620 + (i % 500), 0x2, i & 0xFFFF) for i in range(count)]
+
+    def legacyEncode(teleco, button, code):
+        frame = bytearray(7)
+        frame[0] = 0xA7
+        frame[1] = button << 4
+        frame[2] = code >> 8
+        frame[3] = (code & 0xFF)
+        frame[4] = teleco >> 16
+        frame[5] = ((teleco >>  8) & 0xFF)
+        frame[6] = (teleco & 0xFF)
+        checksum = 0
+        for i in range(0, 7):
+            checksum = checksum ^ frame[i] ^ (frame[i] >> 4)
+        frame[1] |= checksum & 0b1111
+        for i in range(1, 7):
+            frame[i] ^= frame[i-1]
+        bits = []
+        for i in range (0, 56):
+            bits.append((frame[int(i/8)] >> (7 - (i%8))) & 1)
+        return frame, bits
+
+    start = time.perf_counter()
+    legacy = [legacyEncode(*command) for command in commands]
+    legacyTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    frames, symbols = FrameEncoder.encodeBatch(commands)
+    batchTime = time.perf_counter() - start
+
+    for i in range(count):
+        if (legacy[i][0] != frames[i]) or (tuple(legacy[i][1]) != symbols[i]):
+            raise Exception("Encoders disagree for " + str(commands[i]))
+
+    return {'frames': count, 'legacyFramesPerSecond': count / legacyTime, 'batchFramesPerSecond': count / batchTime}
+
+
+if __name__ == '__main__':
+    result = benchmarkEncoder()
+    print("Encoded " + str(result['frames']) + " frames")
+    print("  per-bit loops : %10.0f frames/s" % result['legacyFramesPerSecond'])
+    print("  FrameEncoder  : %10.0f frames/s" % result['batchFramesPerSecond'])
@@ -8,14 +8,18 @@ import locale
 import time
 import datetime
 import ephem
-import pigpio
 import socket
 import signal, atexit, subprocess, traceback
 import logging, logging.handlers
 import threading
+import heapq
+import itertools
+import calendar
+import collections
 
 try:
     from mylog import MyLog
+    from myradio import Transmitter
 except Exception as e1:
     print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
     print("Error: " + str(e1))
@@ -27,10 +31,14 @@ class Event:
     ## repeatType: String: 'once' or 'weekday'
     ## repeatValue: Date in format "YYYY/MM/DD" or Array ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
     ## timeType: String: 'clock' or 'astro' are valid values
-    ## timeValue: String: Time in format "HH:MM" or values 'sunset' or 'sunrise' or 'sunset+MIN', 'sunset-MIN', 'sunrise+MIN', 'sunrise-MIN'
+    ## timeValue: String: Time in format "HH:MM", "HH:MM:SS" or "HH:MM:SS.ffffff" or values 'sunset' or 'sunrise' or 'sunset+MIN', 'sunset-MIN', 'sunrise+MIN', 'sunrise-MIN'
+    ##            The offset to sunset or sunrise is in seconds if followed by 's', e.g. 'sunset+90s' or 'sunrise-7.5s'
     ## shutterAction: String: 'up', 'down' or 'stop' (My-Position) are valid values. If this is followed by an integer, this indicates the duration of the operation
     ## shutterIds: Array of shutterIds to operate
 
+    clockPattern = re.compile(r'^(\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,6}))?)?$')
+    astroPattern = re.compile(r'^(sunrise|sunset)(?:([+-])(\d+(?:\.\d+)?)(s?))?$')
+
     def __init__(self,active,repeatType,repeatValue,timeType,timeValue,shutterAction,shutterIds):
     
         if active not in ('active', 'paused', 'deleted'):
@@ -51,11 +59,10 @@ class Event:
             raise ValueError("%s is not a valid value for TIMETYPE." % timeType)
         self.timeType = timeType
 
-        if (timeType == "clock") and not time.strptime(timeValue, '%H:%M'):
-            raise ValueError("%s is not a valid value for TIMEVALUE (clock)." % timeValue )
-        astro_parts = re.split('\+|\-', timeValue)
-        if (timeType == "astro") and not ((astro_parts[0] in ('sunset', 'sunrise')) and ((len(astro_parts) == 1) or (astro_parts[1] == None or int(astro_parts[1])))):
-            raise ValueError("%s is not a valid value for TIMEVALUE (astro)." % timeValue)
+        if (timeType == "clock"):
+            self.clockTime = self.parseClock(timeValue)
+        else:
+            self.astroEvent, self.astroOffset = self.parseAstro(timeValue)
         self.timeValue = timeValue
 
         # if not ((isinstance(shutterAction, str)) and ((shutterAction.startswith("up") or shutterAction.startswith("down")))):
@@ -65,6 +72,29 @@ class Event:
 
         self.shutterIds = shutterIds
         
+    # Time of the day of a "clock" time value
+    @classmethod
+    def parseClock(cls, timeValue):
+        match = cls.clockPattern.match(timeValue.strip())
+        try:
+            return datetime.time(int(match.group(1)), int(match.group(2)), int(match.group(3) or 0), int((match.group(4) or "0").ljust(6, "0")))
+        except:
+            raise ValueError("%s is not a valid value for TIMEVALUE (clock)." % timeValue )
+
+    # 'sunrise' or 'sunset' and the offset to it of an "astro" time value
+    @classmethod
+    def parseAstro(cls, timeValue):
+        match = cls.astroPattern.match(timeValue.strip())
+        if not match:
+            raise ValueError("%s is not a valid value for TIMEVALUE (astro)." % timeValue)
+        offset = datetime.timedelta(0)
+        if match.group(2):
+            amount = float(match.group(3))
+            offset = datetime.timedelta(seconds=amount) if match.group(4) else datetime.timedelta(minutes=amount)
+            if match.group(2) == "-":
+                offset = -offset
+        return match.group(1), offset
+
     def prettyprint(self):
         outstr  = "active        : "+str(self.active)+"\n"
         outstr += "repeatType    : "+str(self.repeatType)+"\n"
@@ -76,7 +106,196 @@ class Event:
         
         return outstr
            
+class CompiledEvent(object):
+    # What the scheduler needs of an active Event, parsed once
+    __slots__ = ('id', 'weekdays', 'dateOrdinal', 'timeKind', 'seconds', 'action', 'target', 'shutterIds')
+
+    weekDays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    timeClock = 0       # seconds: time of the day
+    timeSunrise = 1     # seconds: offset to sunrise
+    timeSunset = 2      # seconds: offset to sunset
+
+    def __init__(self, id, event):
+        self.id = id
+        self.weekdays = 0           # bit 0 is Monday
+        self.dateOrdinal = None     # day of a 'once' event
+        if (event.repeatType == 'weekday'):
+            for weekday in event.repeatValue:
+                self.weekdays |= 1 << self.weekDays.index(weekday)
+        else:
+            self.dateOrdinal = datetime.datetime.strptime(event.repeatValue, '%Y/%m/%d').toordinal()
+
+        if (event.timeType == "clock"):
+            self.timeKind = self.timeClock
+            self.seconds = event.clockTime.hour * 3600 + event.clockTime.minute * 60 + event.clockTime.second + event.clockTime.microsecond / 1000000.0
+        else:
+            self.timeKind = self.timeSunrise if event.astroEvent == "sunrise" else self.timeSunset
+            self.seconds = event.astroOffset.total_seconds()
+
+        # 'up' or 'down', followed by the target position of a partial movement, or 'stop'
+        self.target = None
+        self.action = "stop"
+        for direction in ("up", "down"):
+            if event.shutterAction.startswith(direction):
+                self.action = direction
+                s = event.shutterAction[len(direction):].strip()
+                s1 = int(s) if s else -1
+                if (0 < s1 < 100):
+                    self.target = s1
+        self.shutterIds = tuple(event.shutterIds)
+
+    def isFullMove(self):
+        return (self.action != "stop") and (self.target == None)
+
+    def getActionText(self):
+        return self.action + (" " + str(self.target) if self.target != None else "")
+
+
+class SunTable(MyLog):
+    # Sunrise and sunset of every day of a year for one location, computed in
+    # one batch and saved to a file, so looking up a day is a list index. The
+    # file holds a header line "<latitude> <longitude> <first day ordinal>"
+    # followed by one line "<sunrise> <sunset>" (UTC timestamps) per day.
+    Days = 366
+    Precision = 6       # decimals of the latitude and longitude that tell locations apart
+
+    def __init__(self, filename = None, log = None, readOnly = False):
+        super(SunTable, self).__init__()
+        self.log = log
+        self.FileName = filename
+        self.ReadOnly = readOnly
+        self.Lock = threading.Lock()
+        self.Location = None
+        self.FirstDay = 0
+        self.Times = []
+        self.OtherDays = {}     # (location, day ordinal) -> times of the days outside of the table
+        self.Attempted = None   # (location, day) of the last rebuild
+
+    #---------------------SunTable::Load----------------------------------------
+    def Load(self):
+        try:
+            if self.FileName != None and os.path.isfile(self.FileName):
+                with open(self.FileName, "r") as SunFile:
+                    header = SunFile.readline().split()
+                    times = [tuple(float(value) for value in line.split()) for line in SunFile if len(line.split()) == 2]
+                self.Location = self.GetLocation(header[0], header[1])
+                self.FirstDay = int(header[2])
+                self.Times = times
+        except Exception as e1:
+            self.LogError("Error in SunTable:Load: " + str(e1))
+            self.Location = None
+            self.Times = []
+
+    #---------------------SunTable::Build---------------------------------------
+    # The times are computed before taking the lock, lookups are not held up
+    def Build(self, latitude, longitude, firstDay):
+        start = time.time()
+        location = self.GetLocation(latitude, longitude)
+        homeLocation = self.GetObserver(location[0], location[1])
+        times = [self.Compute(homeLocation, firstDay + datetime.timedelta(days=days)) for days in range(0, self.Days)]
+        with self.Lock:
+            self.Location = location
+            self.FirstDay = firstDay.toordinal()
+            self.Times = times
+            self.OtherDays = {}
+        self.LogInfo("Computed sunrise and sunset times for " + str(self.Days) + " days in " + "%.1f" % (time.time() - start) + " seconds")
+        self.Save()
+
+    #---------------------SunTable::GetLocation-------------------------------
+    # The location as a key: the config holds floats, the web interface sets
+    # strings, and both must compare equal for the same place
+    @classmethod
+    def GetLocation(cls, latitude, longitude):
+        return (round(float(latitude), cls.Precision), round(float(longitude), cls.Precision))
+
+    #---------------------SunTable::IsStale-------------------------------------
+    # True if the table doesn't cover today at this location and has not been
+    # rebuilt for it yet
+    def IsStale(self, latitude, longitude):
+        location = self.GetLocation(latitude, longitude)
+        today = datetime.date.today()
+        with self.Lock:
+            if (self.Location == location) and (self.FirstDay <= today.toordinal() < self.FirstDay + len(self.Times)):
+                return False
+            return self.Attempted != (location, today)
+
+    #---------------------SunTable::Update--------------------------------------
+    # Rebuild the table from today if it is stale. Called by the scheduler
+    # thread, so a lookup never pays for the whole year.
+    def Update(self, latitude, longitude):
+        if not self.IsStale(latitude, longitude):
+            return
+        location = self.GetLocation(latitude, longitude)
+        today = datetime.date.today()
+        with self.Lock:
+            self.Attempted = (location, today)
+        try:
+            self.Build(location[0], location[1], today)
+        except Exception as e1:
+            self.LogError("Error in SunTable:Update: " + str(e1))
+
+    #---------------------SunTable::GetObserver--------------------------------
+    @staticmethod
+    def GetObserver(latitude, longitude):
+        homeLocation = ephem.Observer()
+        # ephem takes strings as degrees, floats as radians
+        homeLocation.lat = str(latitude)
+        homeLocation.lon = str(longitude)
+        return homeLocation
+
+    #---------------------SunTable::Compute-------------------------------------
+    # UTC timestamps of the sunrise and the sunset of one day
+    @staticmethod
+    def Compute(homeLocation, day):
+        homeLocation.date = day.strftime("%Y/%m/%d 00:00:00")
+        sunrise = homeLocation.next_rising(ephem.Sun()).datetime()
+        sunset = homeLocation.next_setting(ephem.Sun()).datetime()
+        return (calendar.timegm(sunrise.timetuple()) + sunrise.microsecond / 1000000.0,
+                calendar.timegm(sunset.timetuple()) + sunset.microsecond / 1000000.0)
+
+    #---------------------SunTable::Save----------------------------------------
+    def Save(self):
+        if (self.FileName == None) or self.ReadOnly:
+            return
+        try:
+            tmpFileName = self.FileName + ".tmp"
+            with open(tmpFileName, "w") as SunFile:
+                SunFile.write(repr(self.Location[0]) + " " + repr(self.Location[1]) + " " + str(self.FirstDay) + "\n")
+                for sunrise, sunset in self.Times:
+                    SunFile.write("%.3f %.3f\n" % (sunrise, sunset))
+            os.replace(tmpFileName, self.FileName)
+        except Exception as e1:
+            self.LogError("Error in SunTable:Save: " + str(e1))
+
+    #---------------------SunTable::Get-----------------------------------------
+    # Local sunrise and sunset on 'day'. Days the table doesn't hold (other
+    # location, outside of the year it was built for) are computed on their
+    # own, and kept until the next rebuild (a simulation looks them up many
+    # times). The table itself is only rebuilt by Update.
+    def Get(self, latitude, longitude, day):
+        location = self.GetLocation(latitude, longitude)
+        with self.Lock:
+            index = day.toordinal() - self.FirstDay
+            if (self.Location == location) and (index >= 0) and (index < len(self.Times)):
+                sunrise, sunset = self.Times[index]
+            elif (location, day.toordinal()) in self.OtherDays:
+                sunrise, sunset = self.OtherDays[(location, day.toordinal())]
+            else:
+                sunrise, sunset = self.Compute(self.GetObserver(location[0], location[1]), day)
+                if len(self.OtherDays) >= self.Days:
+                    self.OtherDays = {}
+                self.OtherDays[(location, day.toordinal())] = (sunrise, sunset)
+            return datetime.datetime.fromtimestamp(sunrise), datetime.datetime.fromtimestamp(sunset)
+
+
 class Schedule(MyLog):
+    # Kind of the changes in the change feed
+    changeAdded = 'added'
+    changeEdited = 'edited'
+    changeRemoved = 'removed'
+    changeAll = 'all'           # e.g. the location, that moves every astro event
+    historySize = 256
+
     def __init__(self, log = None, config = None):
         super(Schedule, self).__init__()
         self.lock = threading.Lock()
@@ -85,7 +304,9 @@ class Schedule(MyLog):
         self.config = config
 
         self.schedule = {}
-        self.setUpdateTime()
+        self.listeners = []
+        self.version = 0
+        self.changes = collections.deque(maxlen=self.historySize)  # (version, kind, id)
         
     def addEvent(self, id, evt):
         if id in self.schedule.items():
@@ -95,11 +316,12 @@ class Schedule(MyLog):
         self.lock.acquire()
         try:
             self.LogDebug('addEvent: Lock aquired')
+            kind = self.changeEdited if id in self.schedule else self.changeAdded
             self.schedule[id] = evt
-            self.setUpdateTime()
         finally:
             self.lock.release()
             self.LogDebug('addEvent: Lock released')
+        self.recordChange(kind, id)
             
     def getNewId(self):
         ids = []
@@ -109,17 +331,17 @@ class Schedule(MyLog):
             return 1
         return (max(ids)+1)
             
-    def addOneEventByTime(self, shutterIds, shutterAction, hour, minute):
+    def addOneEventByTime(self, shutterIds, shutterAction, hour, minute, second = 0):
         try: 
-            evt = Event('active', 'once', datetime.datetime.today().strftime('%Y/%m/%d'), "clock", str(hour)+":"+str(minute), shutterAction, shutterIds)
+            evt = Event('active', 'once', datetime.datetime.today().strftime('%Y/%m/%d'), "clock", str(hour)+":"+str(minute)+":"+str(second), shutterAction, shutterIds)
             self.addEvent(self.getNewId(), evt)
         except ValueError as ex:
             self.LogError("Failed to add event: "+ str(ex))
             pass
 
-    def addRepeatEventByTime(self, shutterIds, shutterAction, hour, minute, weekdays):
+    def addRepeatEventByTime(self, shutterIds, shutterAction, hour, minute, weekdays, second = 0):
         try: 
-            evt = Event('active', 'weekday', weekdays, "clock", str(hour)+":"+str(minute), shutterAction, shutterIds)
+            evt = Event('active', 'weekday', weekdays, "clock", str(hour)+":"+str(minute)+":"+str(second), shutterAction, shutterIds)
             self.addEvent(self.getNewId(), evt)
         except ValueError as ex:
             self.LogError("Failed to add event: "+ str(ex))
@@ -184,8 +406,6 @@ class Schedule(MyLog):
 
         evt =  Event(active,repeatType,repeatValueList,timeType,timeValue,shutterAction,shutterIdsList)
         self.addEvent(str(id), evt)
-            
-        self.setUpdateTime()
         return { 'status': 'OK', 'id': str(id) }
 
     def editSchedule(self, id, data):
@@ -209,11 +429,8 @@ class Schedule(MyLog):
                                         'timeType': timeType, 'timeValue': timeValue, 'shutterAction': shutterAction, 
                                         'shutterIds': shutterIdsStr}
 
-            self.schedule.pop(id, None)
             evt =  Event(active,repeatType,repeatValueList,timeType,timeValue,shutterAction,shutterIdsList)
             self.addEvent(id, evt)
-            
-            self.setUpdateTime()
             return {'status': 'OK'}
 
     def deleteSchedule(self, id):
@@ -226,7 +443,7 @@ class Schedule(MyLog):
                                             evt['shutterIds'], section="Scheduler");
             self.config.Schedule.pop(id, None)
             self.schedule.pop(id, None)
-            self.setUpdateTime()
+            self.recordChange(self.changeRemoved, id)
             return {'status': 'OK'}
             
     def printSchedule(self):
@@ -246,17 +463,295 @@ class Schedule(MyLog):
                 obj[id] = item
         return obj
 
-    def setUpdateTime(self):
-        self.updateTime = int(time.time())
+    # Record a change of the event 'id' in the change feed and tell the listeners
+    def recordChange(self, kind, id = None):
+        with self.lock:
+            self.version += 1
+            self.changes.append((self.version, kind, id))
+            version = self.version
+        for listener in self.listeners:
+            listener(version)
+
+    # Every event may have moved, e.g. after a change of the location
+    def locationChanged(self):
+        self.recordChange(self.changeAll)
+
+    # Returns (current version, [(kind, id), ...] of the changes made after the
+    # version 'since'). The list is None when every event must be reloaded:
+    # 'since' is None or older than the history, or one change affects all the events.
+    def getChanges(self, since):
+        with self.lock:
+            if since == self.version:
+                return self.version, []
+            if (since == None) or (len(self.changes) == 0) or (self.changes[0][0] > since + 1):
+                return self.version, None
+            changes = [(kind, id) for version, kind, id in self.changes if version > since]
+            if any(kind == self.changeAll for kind, id in changes):
+                return self.version, None
+            return self.version, changes
+
+    # 'listener(version)' is called after every change, see getChanges
+    def registerListener(self, listener):
+        self.listeners.append(listener)
+
+
+class ActionDispatcher(threading.Thread, MyLog):
+    # Runs the actions of the scheduled events without blocking the scheduler.
+    # The commands of the shutters of an event are spread over ScheduleStagger
+    # seconds, the often missed shutters first, and planned within the frame
+    # budget of the transmitter. The repetitions of full up and down movements
+    # follow every repeatInterval seconds, or faster to fit in the deadline,
+    # and are only sent once the first commands of all the events have been sent.
+    repeatInterval = 5.0
+    missWindow = 600.0      # seconds after a command during which the same command by hand means it was missed
+    missDecay = 0.9         # weight of the past misses at every new command
+    reportSize = 256        # commands kept in the send report
+
+    def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
+        threading.Thread.__init__(self, group=group, target=target, name="Dispatcher")
+        MyLog.__init__(self)
+        self.shutdown_flag = threading.Event()
+        self.daemon = True
+
+        self.args = args
+        self.kwargs = kwargs
+        if kwargs["log"] != None:
+            self.log = kwargs["log"]
+        self.shutter = kwargs["shutter"]
+        self.config = kwargs["config"]
+
+        self.condition = threading.Condition()
+        self.tasks = []             # heap of (time, sequence, shutterId, event, report, send record)
+        self.sequence = itertools.count()
+        self.statsLock = threading.Lock()
+        self.dispatched = 0
+        self.deadlineMisses = 0
+        self.lastLatency = 0.0
+        self.maxLatency = 0.0
+        self.missScore = {}         # shutterId -> decayed count of the missed commands
+        self.lastCommands = {}      # shutterId -> (button, time, dispatch time) of the last full move or stop sent
+        self.sendReport = collections.deque(maxlen=self.reportSize)
+        self.lastSlip = 0.0
+        self.maxSlip = 0.0
+        return
+
+    #---------------------ActionDispatcher::dispatch----------------------------
+    # Command the shutters of a CompiledEvent, all of them by default
+    def dispatch(self, event, shutterIds = None):
+        if shutterIds == None:
+            shutterIds = event.shutterIds
+        now = time.monotonic()
+        deadline = self.config.ScheduleDeadline
+        repeats = self.config.SendRepeat if event.isFullMove() else 1
+        interval = self.repeatInterval
+        if repeats > 1:
+            interval = min(interval, deadline / repeats)
+        budget = self.shutter.transmitter.frameBudget
+        # the spreading leaves the air time of the first commands within the deadline
+        airTime = len(shutterIds) * self.config.SendRepeat / budget.budget if budget.budget > 0 else 0.0
+        stagger = min(self.config.ScheduleStagger, max(0.0, deadline - airTime)) / len(shutterIds) if len(shutterIds) > 0 else 0.0
+        with self.statsLock:
+            shutterIds = sorted(shutterIds, key=lambda shutterId: -self.missScore.get(shutterId, 0.0))
+        report = {'id': event.id, 'start': now, 'deadline': deadline, 'pending': len(shutterIds), 'commanded': now}
+        with self.condition:
+            # the first commands of all the shutters are booked before any repetition
+            firsts = []
+            for index, shutterId in enumerate(shutterIds):
+                first = budget.book(now + index * stagger, self.config.SendRepeat)
+                self.schedule(first, shutterId, event, report, now, 0)
+                firsts.append(first)
+            for i in range(1, repeats):
+                for shutterId, first in zip(shutterIds, firsts):
+                    self.schedule(budget.book(first + i * interval, self.config.SendRepeat), shutterId, event, None, now, i)
+            self.condition.notify()
+        with self.statsLock:
+            self.dispatched += 1
+
+    #---------------------ActionDispatcher::schedule----------------------------
+    # Called with the condition held
+    def schedule(self, when, shutterId, event, report, start, repeat):
+        record = {'id': event.id, 'shutterId': shutterId, 'repeat': repeat, 'command': 'first' if repeat == 0 else 'repeat',
+                  'planned': when - start, 'sent': None, 'onAir': None, 'end': None, 'sentFrames': 0, 'cancelledFrames': 0,
+                  'missed': False, 'start': start}
+        heapq.heappush(self.tasks, (when, next(self.sequence), shutterId, event, report, record))
+
+    #---------------------ActionDispatcher::wakeup------------------------------
+    def wakeup(self):
+        with self.condition:
+            self.condition.notify()
+
+    #---------------------ActionDispatcher::runAction---------------------------
+    # Returns the Future of the command sent, None if nothing was sent
+    def runAction(self, shutterId, event, priority = None):
+        try:
+            self.LogInfo("Send action \""+event.getActionText()+"\" to shutterId \""+shutterId+"\" at " + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+            if (event.action == "up"):
+                if (event.target != None):
+                    if (self.shutter.getPosition(shutterId) < event.target):   #Is Shutter below requested Position?
+                        return self.shutter.risePartial(shutterId, event.target)
+                    else:
+                        self.LogWarn("Send action \""+event.getActionText()+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or above requested position")
+                else :  
+                    return self.shutter.rise(shutterId, priority)
+            elif (event.action == "down"):
+                if (event.target != None):
+                    if (self.shutter.getPosition(shutterId) > event.target):   #Is Shutter above requested Position?
+                        return self.shutter.lowerPartial(shutterId, event.target)
+                    else:
+                        self.LogWarn("Send action \""+event.getActionText()+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or below requested position")
+                else :  
+                    return self.shutter.lower(shutterId, priority)
+            elif (event.action == "stop"):
+                return self.shutter.stop(shutterId)
+        except:
+            self.LogError ("Error: cannot open "+shutterId)
+            self.LogError (traceback.format_exc())
+        return None
+
+    #---------------------ActionDispatcher::commanded---------------------------
+    # Called once the first command for a shutter of an event has been sent
+    def commanded(self, report, future):
+        if (future != None) and not future.cancelled() and (future.exception() == None):
+            onAirTime = future.result()['onAirTime']
+            if onAirTime != None:
+                report['commanded'] = max(report['commanded'], onAirTime)
+        with self.statsLock:
+            report['pending'] -= 1
+            if report['pending'] > 0:
+                return
+            latency = report['commanded'] - report['start']
+            self.lastLatency = latency
+            self.maxLatency = max(self.maxLatency, latency)
+            if latency > report['deadline']:
+                self.deadlineMisses += 1
+        if latency > report['deadline']:
+            self.LogWarn("Event "+str(report['id'])+": all shutters commanded after "+"%.1f" % latency+" seconds, missing the deadline of "+str(report['deadline'])+" seconds")
+        else:
+            self.LogInfo("Event "+str(report['id'])+": all shutters commanded within "+"%.1f" % latency+" seconds")
+
+    #---------------------ActionDispatcher::sent--------------------------------
+    # Called once a command has been sent, or failed. 'record' gets the send
+    # time, relative to the dispatch of the event as the planned time.
+    def sent(self, shutterId, event, record, future):
+        failed = (future == None) or future.cancelled() or (future.exception() != None)
+        with self.statsLock:
+            record['missed'] = failed and (future != None)
+            if not failed:
+                result = future.result()
+                record['sent'] = result['startTime'] - record['start']
+                record['onAir'] = result['onAirTime'] - record['start'] if result['onAirTime'] != None else None
+                record['end'] = result['endTime'] - record['start']
+                record['sentFrames'] = result['sentFrames']
+                record['cancelledFrames'] = result['cancelledFrames']
+                self.lastSlip = record['sent'] - record['planned']
+                self.maxSlip = max(self.maxSlip, self.lastSlip)
+                if record['repeat'] == 0:
+                    if shutterId in self.missScore:
+                        self.missScore[shutterId] *= self.missDecay
+                    if event.target == None:
+                        self.lastCommands[shutterId] = (self.getButton(event), time.monotonic(), record['start'])
+            self.sendReport.append(record)
+        if future == None:
+            return  # canceled, the shutter was already in position
+        if failed:
+            self.missed(shutterId, "the "+("first command" if record['repeat'] == 0 else "repeat "+str(record['repeat']))+" could not be sent")
+            return
+        self.LogDebug("Event "+str(record['id'])+": command "+str(record['repeat'])+" for "+shutterId+" planned at +"+"%.2f" % record['planned']+
+                      "s, sent at +"+"%.2f" % record['sent']+"s, "+str(record['sentFrames'])+" frames until +"+"%.2f" % record['end']+"s")
+
+    #---------------------ActionDispatcher::getButton---------------------------
+    def getButton(self, event):
+        if event.action == "up":
+            return self.shutter.buttonUp
+        if event.action == "down":
+            return self.shutter.buttonDown
+        return self.shutter.buttonStop
+
+    #---------------------ActionDispatcher::commandSent-------------------------
+    # Called for every command sent to a shutter. The same full move or stop
+    # sent by hand shortly after the scheduled one means the shutter missed it.
+    def commandSent(self, shutterId, button):
+        if threading.current_thread() is self:
+            return
+        with self.statsLock:
+            last = self.lastCommands.pop(shutterId, None)
+        if (last != None) and (last[0] == button) and (time.monotonic() - last[1] < self.missWindow):
+            with self.statsLock:
+                # the first command and its repetitions were all missed
+                for record in self.sendReport:
+                    if (record['shutterId'] == shutterId) and (record['start'] == last[2]):
+                        record['missed'] = True
+            self.missed(shutterId, "the same command was sent by hand "+"%.0f" % (time.monotonic() - last[1])+" seconds later")
+
+    #---------------------ActionDispatcher::missed------------------------------
+    def missed(self, shutterId, reason):
+        with self.statsLock:
+            self.missScore[shutterId] = self.missScore.get(shutterId, 0.0) * self.missDecay + 1.0
+        self.LogWarn("Scheduled command for "+shutterId+" missed: "+reason)
+
+    #---------------------ActionDispatcher::getSendReport-----------------------
+    # Planned and actual send times of the last commands, in seconds after the
+    # dispatch of their event: 'sent' when the transmitter started the command,
+    # 'onAir' when the first frame was received, 'end' when the last frame was
+    # sent, and the number of frames sent and cancelled
+    def getSendReport(self):
+        with self.statsLock:
+            return [dict(record) for record in self.sendReport]
+
+    #---------------------ActionDispatcher::getStats----------------------------
+    def getStats(self):
+        with self.statsLock:
+            return {'dispatched': self.dispatched, 'deadlineMisses': self.deadlineMisses,
+                    'lastLatency': self.lastLatency, 'maxLatency': self.maxLatency,
+                    'lastSlip': self.lastSlip, 'maxSlip': self.maxSlip,
+                    'missScore': dict(self.missScore)}
+
+    def run(self):
+        self.shutter.registerCommandCallBack(self.commandSent)
+        while not self.shutdown_flag.is_set():
+            with self.condition:
+                if len(self.tasks) == 0:
+                    self.condition.wait()
+                    continue
+                delay = self.tasks[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                when, sequence, shutterId, event, report, record = heapq.heappop(self.tasks)
+
+            future = self.runAction(shutterId, event, None if report != None else Transmitter.priorityRepeat)
+            if future == None:
+                self.sent(shutterId, event, record, None)
+            else:
+                future.add_done_callback(lambda future, shutterId = shutterId, event = event, record = record: self.sent(shutterId, event, record, future))
+            if report != None:
+                if future == None:
+                    self.commanded(report, None)
+                else:
+                    future.add_done_callback(lambda future, report = report: self.commanded(report, future))
+        return
+
+
+class VirtualClock(object):
+    # Stands for datetime.datetime.now() to run the scheduler in simulated time
+    def __init__(self, start = None):
+        self.time = start if start != None else datetime.datetime.now()
+
+    def now(self):
+        return self.time
+
+    def advance(self, time):
+        self.time = max(self.time, time)
 
-    def getUpdateTime(self):
-        return self.updateTime
-        
 
 class Scheduler(threading.Thread, MyLog):
+    weekDays = CompiledEvent.weekDays
+    checkInterval = 900     # longest sleep without checking the clock, when no timer is due earlier
+    clockTolerance = 5      # seconds the clock can drift between two checks before it counts as a jump
 
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None):
         threading.Thread.__init__(self, group=group, target=target, name="Scheduler")
+        MyLog.__init__(self)
         self.shutdown_flag = threading.Event()
         
         self.args = args
@@ -266,102 +761,422 @@ class Scheduler(threading.Thread, MyLog):
         self.schedule = kwargs["schedule"]
         self.shutter = kwargs["shutter"]
         self.config = kwargs["config"]
-        self.weekday = datetime.datetime.today().weekday()
-        self.lastScheduleUpdateTime = 0
-        self.currentSchedule = {}
+        self.now = kwargs["clock"].now if "clock" in kwargs else datetime.datetime.now
+
+        self.condition = threading.Condition()
+        self.timers = []            # heap of (fire time, sequence, event id)
+        self.nextFire = {}          # event id -> sequence of its valid timer
+        self.scheduleVersion = None # version of the schedule the timers are built from
+        self.events = {}            # event id -> CompiledEvent of the active events
+        self.weekdayIndex = [set() for weekday in range(0, 7)]  # weekday -> ids of the weekday events
+        self.dateIndex = {}         # date ordinal -> ids of the 'once' events
+        self.sequence = itertools.count()
+        self.statsLock = threading.Lock()
+        self.fired = 0
+        self.totalJitter = 0.0
+        self.lastJitter = 0.0
+        self.maxJitter = 0.0
+        self.caughtUp = 0
+        self.clockJumps = 0
+        self.lastPass = time.time()                 # last time the timers due were all handled (UTC timestamp)
+        self.lastPassMonotonic = time.monotonic()
+        self.passFileName = self.config.FileName + ".pass" if (self.config.FileName != None) and not self.config.ReadOnly else None
+        # a read only config (e.g. a simulation) keeps the sun table in memory and doesn't record the passes
+        self.sunTable = SunTable(self.config.FileName + ".sun" if self.config.FileName != None else None, log = self.log, readOnly = self.config.ReadOnly)
+        self.sunTable.Load()
+        self.dispatcher = ActionDispatcher(kwargs={'log':self.log, 'shutter': self.shutter, 'config': self.config})
 
-        self.homeLocation = ephem.Observer()
         locale.setlocale(locale.LC_TIME,'')
+        self.schedule.registerListener(self.scheduleChanged)
         return
 
-    def updateSchedule(self):
-        weekDays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-        
-        self.homeLocation.lat = str(self.config.Latitude)
-        self.homeLocation.lon = str(self.config.Longitude)
-        self.homeLocation.date = datetime.datetime.now().strftime("%Y/%m/%d 00:00:00")
-        sunrise = ephem.localtime(self.homeLocation.next_rising(ephem.Sun()))
-        sunset = ephem.localtime(self.homeLocation.next_setting(ephem.Sun()))
-        weekday = weekDays[datetime.datetime.today().weekday()]
-        date    = datetime.datetime.today().strftime('%Y/%m/%d')
-        self.LogInfo("Today is "+date+", a "+weekday+", Sunrise is at "+str(sunrise.time())+" and Sunset is at "+ str(sunset.time()));
-
-        self.currentSchedule = {}
-        for id, event in self.schedule.getSchedule().items():
-            if ((event.active == "active") and (((event.repeatType == 'weekday') and (weekday in event.repeatValue)) or ((event.repeatType == 'once') and (date == event.repeatValue)))):
-                if (event.timeType == "clock"):
-                    eventTime = datetime.time(int(event.timeValue.split(":")[0]), int(event.timeValue.split(":")[1]), 0)
-                elif ((event.timeType == "astro") and (event.timeValue.startswith("sunrise"))):
-                    eventTime = (sunrise + datetime.timedelta(minutes=int(event.timeValue[7:] or 0))).time()
-                elif ((event.timeType == "astro") and (event.timeValue.startswith("sunset"))):
-                    eventTime = (sunset + datetime.timedelta(minutes=int(event.timeValue[6:] or 0))).time()
-
-                if (eventTime > datetime.datetime.now().time()): 
-                    eventTimeStr = "%02d:%02d" % (eventTime.hour, eventTime.minute)
-                    if not eventTimeStr in self.currentSchedule:
-                        self.currentSchedule[eventTimeStr] = []
-                    self.currentSchedule[eventTimeStr].append([event.shutterIds, event.shutterAction])  
-        self.LogDebug(str(self.currentSchedule))
-    
+    #---------------------Scheduler::updateSunTable-----------------------------
+    def updateSunTable(self):
+        self.sunTable.Update(self.config.Latitude, self.config.Longitude)
+
+    #---------------------Scheduler::getSunTimes--------------------------------
+    def getSunTimes(self, day):
+        return self.sunTable.Get(self.config.Latitude, self.config.Longitude, day)
+
+    #---------------------Scheduler::getEventTime-------------------------------
+    # Time of the event on the given day
+    def getEventTime(self, event, day):
+        if (event.timeKind == CompiledEvent.timeClock):
+            return datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(seconds=event.seconds)
+        sunrise, sunset = self.getSunTimes(day)
+        if (event.timeKind == CompiledEvent.timeSunrise):
+            return sunrise + datetime.timedelta(seconds=event.seconds)
+        return sunset + datetime.timedelta(seconds=event.seconds)
+
+    #---------------------Scheduler::getNextFireTime----------------------------
+    # First time the event fires after 'after', None if it never does
+    def getNextFireTime(self, event, after):
+        if (event.dateOrdinal != None):
+            day = datetime.date.fromordinal(event.dateOrdinal)
+            if day < after.date():
+                return None
+            eventTime = self.getEventTime(event, day)
+            return eventTime if eventTime > after else None
+        for days in range(0, 8):
+            day = after.date() + datetime.timedelta(days=days)
+            if (event.weekdays & (1 << day.weekday())):
+                eventTime = self.getEventTime(event, day)
+                if (eventTime > after):
+                    return eventTime
+        return None
+
+    #---------------------Scheduler::planDay------------------------------------
+    # Sorted list of (fire time, event id) of the events of one day. Only the
+    # events indexed for that day are looked at.
+    def planDay(self, day):
+        ids = self.weekdayIndex[day.weekday()] | self.dateIndex.get(day.toordinal(), set())
+        return sorted((self.getEventTime(self.events[id], day), id) for id in ids)
+
+    #---------------------Scheduler::compile------------------------------------
+    # Replace the compiled version of one event. Called with the condition held.
+    def compile(self, id, event):
+        compiled = self.events.pop(id, None)
+        if compiled != None:
+            if compiled.dateOrdinal != None:
+                self.dateIndex[compiled.dateOrdinal].discard(id)
+                if len(self.dateIndex[compiled.dateOrdinal]) == 0:
+                    del self.dateIndex[compiled.dateOrdinal]
+            for weekday in range(0, 7):
+                self.weekdayIndex[weekday].discard(id)
+        if (event == None) or (event.active != "active"):
+            return
+        try:
+            compiled = CompiledEvent(id, event)
+        except:
+            self.LogError("Error: cannot compile event "+str(id))
+            self.LogError(traceback.format_exc())
+            return
+        self.events[id] = compiled
+        if compiled.dateOrdinal != None:
+            self.dateIndex.setdefault(compiled.dateOrdinal, set()).add(id)
+        for weekday in range(0, 7):
+            if compiled.weekdays & (1 << weekday):
+                self.weekdayIndex[weekday].add(id)
+
+    #---------------------Scheduler::reschedule---------------------------------
+    # Replace the timer of one event. Called with the condition held.
+    def reschedule(self, id, after):
+        self.nextFire.pop(id, None)
+        event = self.events.get(id)
+        if event == None:
+            return
+        try:
+            fireTime = self.getNextFireTime(event, after)
+        except:
+            self.LogError("Error: cannot schedule event "+str(id))
+            self.LogError(traceback.format_exc())
+            return
+        if fireTime != None:
+            self.addTimer(id, fireTime)
+
+    #---------------------Scheduler::addTimer-----------------------------------
+    # Called with the condition held
+    def addTimer(self, id, fireTime):
+        sequence = next(self.sequence)
+        heapq.heappush(self.timers, (fireTime, sequence, id))
+        self.nextFire[id] = sequence
+        self.LogDebug("Event "+str(id)+" will fire at "+fireTime.strftime("%Y/%m/%d %H:%M:%S"))
+
+    #---------------------Scheduler::rescheduleAll------------------------------
+    # Rebuild all the timers day by day. Called with the condition held.
+    def rescheduleAll(self, after):
+        self.nextFire = {}
+        self.timers = []
+        remaining = set(self.events)
+        for days in range(0, 8):
+            if len(remaining) == 0:
+                break
+            for fireTime, id in self.planDay(after.date() + datetime.timedelta(days=days)):
+                if (id in remaining) and (fireTime > after):
+                    self.addTimer(id, fireTime)
+                    remaining.discard(id)
+        # 'once' events more than a week ahead
+        for id in remaining:
+            self.reschedule(id, after)
+
+    #---------------------Scheduler::scheduleChanged----------------------------
+    # Called by the schedule after a change: apply the changes made since the
+    # last call, reloading everything only when the change feed requires it
+    def scheduleChanged(self, version = None):
+        now = self.now()
+        with self.condition:
+            self.scheduleVersion, changes = self.schedule.getChanges(self.scheduleVersion)
+            if changes == None:
+                self.LogDebug("Reloading the schedule, version "+str(self.scheduleVersion))
+                self.events = {}
+                self.weekdayIndex = [set() for weekday in range(0, 7)]
+                self.dateIndex = {}
+                for eventId, event in list(self.schedule.getSchedule().items()):
+                    self.compile(eventId, event)
+                self.rescheduleAll(now)
+            else:
+                # an event changed several times is only reloaded once
+                for id in collections.OrderedDict((id, kind) for kind, id in changes):
+                    self.LogDebug("Updating event "+str(id)+", schedule version "+str(self.scheduleVersion))
+                    self.compile(id, self.schedule.getSchedule().get(id))
+                    self.reschedule(id, now)
+            self.condition.notify()
+
+    #---------------------Scheduler::catchUp-----------------------------------
+    # Run the latest action of each shutter due after 'since' and up to 'now',
+    # within the catch up window. Returns the number of shutters commanded.
+    # Called with the condition held.
+    def catchUp(self, since, now):
+        grace = self.config.ScheduleCatchUp
+        if grace <= 0:
+            return 0
+        start = max(since, now - datetime.timedelta(seconds=grace))
+        latest = {}         # shutterId -> (fire time, CompiledEvent)
+        day = start.date()
+        while day <= now.date():
+            for fireTime, id in self.planDay(day):
+                if (fireTime > start) and (fireTime <= now):
+                    for shutterId in self.events[id].shutterIds:
+                        latest[shutterId] = (fireTime, self.events[id])
+            day += datetime.timedelta(days=1)
+
+        shutterIds = collections.OrderedDict()    # event id -> shutters it is the latest action of
+        for shutterId, (fireTime, event) in sorted(latest.items(), key=lambda item: item[1][0]):
+            shutterIds.setdefault(event.id, (event, []))[1].append(shutterId)
+        for id, (event, ids) in shutterIds.items():
+            self.LogInfo("Catching up event "+str(id)+" missed since "+since.strftime("%Y/%m/%d %H:%M:%S")+" for "+", ".join(ids))
+            self.dispatcher.dispatch(event, ids)
+        with self.statsLock:
+            self.caughtUp += len(latest)
+        return len(latest)
+
+    #---------------------Scheduler::resume------------------------------------
+    # Nothing has been handled since the UTC timestamp 'since': replace the timers
+    # that went by, which would replay every missed event, by the catch up.
+    # Called with the condition held.
+    def resume(self, since):
+        now = self.now()
+        self.rescheduleAll(now)
+        caughtUp = self.catchUp(datetime.datetime.fromtimestamp(since), now)
+        self.lastPass = time.time()
+        self.lastPassMonotonic = time.monotonic()
+        if caughtUp > 0:
+            self.saveLastPass()
+
+    #---------------------Scheduler::checkClock---------------------------------
+    # Detect the clock jumps and suspends, by comparing the progress of the UTC
+    # time to that of the monotonic clock since the last check, so daylight
+    # saving time changes don't count. Called with the condition held.
+    def checkClock(self):
+        now = time.time()
+        monotonic = time.monotonic()
+        drift = (now - self.lastPass) - (monotonic - self.lastPassMonotonic)
+        if drift > self.clockTolerance:
+            self.LogWarn("Clock jumped forward by "+"%.1f" % drift+" seconds")
+            with self.statsLock:
+                self.clockJumps += 1
+            self.resume(self.lastPass)
+            return
+        elif drift < -self.clockTolerance:
+            # the timers are after the last pass, the events are not run twice
+            self.LogWarn("Clock jumped backward by "+"%.1f" % -drift+" seconds")
+            with self.statsLock:
+                self.clockJumps += 1
+        self.lastPass = now
+        self.lastPassMonotonic = monotonic
+
+    #---------------------Scheduler::loadLastPass-------------------------------
+    # Returns the UTC timestamp of the last pass saved by a previous run, None
+    # if there is none
+    def loadLastPass(self):
+        try:
+            if self.passFileName != None and os.path.isfile(self.passFileName):
+                with open(self.passFileName, "r") as PassFile:
+                    return float(PassFile.read().strip())
+        except Exception as e1:
+            self.LogError("Error in Scheduler:loadLastPass: " + str(e1))
+        return None
+
+    #---------------------Scheduler::saveLastPass-------------------------------
+    # Save the time up to which the events have been handled, after events
+    # fired. A timer already due is not handled yet, so it is caught up if the
+    # program stops now. The file is replaced in one go, a power cut leaves
+    # either the old or the new time. Called with the condition held.
+    def saveLastPass(self):
+        if self.passFileName == None:
+            return
+        handled = time.time()
+        if (len(self.timers) > 0) and (self.timers[0][0] <= self.now()):
+            handled = min(handled, time.mktime(self.timers[0][0].timetuple()) + self.timers[0][0].microsecond / 1000000.0 - 0.000001)
+        try:
+            tmpFileName = self.passFileName + ".tmp"
+            with open(tmpFileName, "w") as PassFile:
+                PassFile.write(repr(handled))
+                PassFile.flush()
+                os.fsync(PassFile.fileno())
+            os.replace(tmpFileName, self.passFileName)
+        except Exception as e1:
+            self.LogError("Error in Scheduler:saveLastPass: " + str(e1))
+
+    #---------------------Scheduler::getStats----------------------------------
+    # How late the events fired, in seconds, and the events caught up
+    def getStats(self):
+        with self.statsLock:
+            return {'fired': self.fired, 'lastJitter': self.lastJitter, 'maxJitter': self.maxJitter,
+                    'averageJitter': (self.totalJitter / self.fired) if self.fired else 0.0,
+                    'caughtUp': self.caughtUp, 'clockJumps': self.clockJumps}
+
+    #---------------------Scheduler::wakeup-------------------------------------
+    def wakeup(self):
+        with self.condition:
+            self.condition.notify()
+
+    #---------------------Scheduler::nextEvent----------------------------------
+    # Sleep until the earliest timer is due. Returns (id, CompiledEvent, fire time).
+    def nextEvent(self):
+        with self.condition:
+            while not self.shutdown_flag.is_set():
+                # only checked on a wake up: a timer due, a change, or checkInterval
+                self.checkClock()
+                if self.sunTable.IsStale(self.config.Latitude, self.config.Longitude):
+                    return None     # rebuilt by run(), without holding the condition
+                if len(self.timers) == 0:
+                    self.condition.wait(self.checkInterval)
+                    continue
+                delay = (self.timers[0][0] - self.now()).total_seconds()
+                if delay > 0:
+                    self.condition.wait(min(delay, self.checkInterval))
+                    continue
+                nextEvent = self.popTimer()
+                if nextEvent != None:
+                    return nextEvent
+        return None
+
+    #---------------------Scheduler::popTimer-----------------------------------
+    # Remove the earliest timer and schedule the next time its event fires.
+    # Returns (id, CompiledEvent, fire time), None if the timer was not valid
+    # anymore. Called with the condition held.
+    def popTimer(self):
+        fireTime, sequence, id = heapq.heappop(self.timers)
+        if self.nextFire.get(id) != sequence:
+            return None     # the event has been changed or deleted since
+        event = self.events.get(id)
+        self.reschedule(id, fireTime)
+        if event == None:
+            return None
+        return id, event, fireTime
+
+    #---------------------Scheduler::simulate-----------------------------------
+    # Fire the timers of the next 'days' days straight away, moving the virtual
+    # clock the scheduler was created with. Nothing is sent. Returns the list of
+    # (fire time, CompiledEvent) in firing order.
+    def simulate(self, days):
+        clock = self.kwargs["clock"]
+        end = clock.now() + datetime.timedelta(days=days)
+        timeline = []
+        self.updateSunTable()
+        with self.condition:
+            self.scheduleVersion = None
+            self.scheduleChanged()
+            while (len(self.timers) > 0) and (self.timers[0][0] <= end):
+                clock.advance(self.timers[0][0])
+                nextEvent = self.popTimer()
+                if nextEvent != None:
+                    timeline.append((nextEvent[2], nextEvent[1]))
+        return timeline
+
     def run(self):
         # self.schedule.printSchedule()
+        self.dispatcher.start()
+        self.updateSunTable()
+        self.scheduleChanged()
+        lastPass = self.loadLastPass()
+        if lastPass != None:
+            with self.condition:
+                self.resume(lastPass)
         while not self.shutdown_flag.is_set():
-            currentScheduleUpdateTime = self.schedule.getUpdateTime();
-            if ((self.lastScheduleUpdateTime < currentScheduleUpdateTime) or (self.weekday != datetime.datetime.today().weekday())):
-                self.updateSchedule()
-                self.weekday = datetime.datetime.today().weekday()
-                self.lastScheduleUpdateTime = currentScheduleUpdateTime
-               
-            ## check next event 
-            timeNow = datetime.datetime.now().time()
-            timeNowStr = "%02d:%02d" % (timeNow.hour, timeNow.minute)
-            eventsToDelete = [];
-            for eventTimeStr, eventDetails in self.currentSchedule.items():
-                if (eventTimeStr <= timeNowStr):
-                    for eventDetail in eventDetails:
-                        for shutterId in eventDetail[0]:
-                            try:
-                                self.LogInfo("Send action \""+eventDetail[1]+"\" to shutterId \""+shutterId+"\" at " + datetime.datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
-                                if (eventDetail[1].startswith("up")):
-                                    s = eventDetail[1][2:].strip()
-                                    s1 = int(s) if s else -1
-                                    if (0 < s1 < 100):
-                                        if (self.shutter.getPosition(shutterId) < s1):   #Is Shutter below requested Position?
-                                            self.shutter.risePartial(shutterId, s1)
-                                        else:
-                                            self.LogWarn("Send action \""+eventDetail[1]+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or above requested position")                                      
-                                    else :  
-                                        for i in range(self.config.SendRepeat):
-                                            self.shutter.rise(shutterId)
-                                            time.sleep(5)
-                                elif (eventDetail[1].startswith("down")):
-                                    s = eventDetail[1][4:].strip()
-                                    s1 = int(s) if s else -1
-                                    if (0 < s1 < 100):
-                                        if (self.shutter.getPosition(shutterId) > s1):   #Is Shutter above requested Position?
-                                            self.shutter.lowerPartial(shutterId, s1)
-                                        else:
-                                            self.LogWarn("Send action \""+eventDetail[1]+"\" to shutterId \""+shutterId+"\" was canceled! Shutter was already at same or below requested position")                                         
-                                    else :  
-                                        for i in range(self.config.SendRepeat):
-                                            self.shutter.lower(shutterId)
-                                            time.sleep(5)
-                                elif (eventDetail[1].startswith("stop")):
-                                    self.shutter.stop(shutterId)
-                            except:
-              	                self.LogError ("Error: cannot open "+shutterId)
-              	                self.LogError (traceback.format_exc())
-                    eventsToDelete.append(eventTimeStr);    
-            for key in eventsToDelete:
-                try:
-                    del self.currentSchedule[key] 
-                except KeyError:
-                    pass
-            if (len(eventsToDelete) > 0):
-                self.LogDebug(str(self.currentSchedule))
-         
-            self.shutdown_flag.wait(60 - datetime.datetime.now().time().second)
-            
+            nextEvent = self.nextEvent()
+            if nextEvent == None:
+                self.updateSunTable()
+                continue
+            id, event, fireTime = nextEvent
+            jitter = (self.now() - fireTime).total_seconds()
+            with self.statsLock:
+                self.fired += 1
+                self.totalJitter += jitter
+                self.lastJitter = jitter
+                self.maxJitter = max(self.maxJitter, jitter)
+            self.LogDebug("Event "+str(id)+" due at "+fireTime.strftime("%H:%M:%S.%f")+" fired "+"%.3f" % jitter+" seconds late")
+            self.dispatcher.dispatch(event)
+            with self.condition:
+                self.saveLastPass()
+
+        self.dispatcher.shutdown_flag.set()
+        self.dispatcher.wakeup()
         self.LogError("Received Signal to shut down Scheduler thread")
         return
 
+
+class ScheduleSimulator(MyLog):
+    # Runs the schedule on a virtual clock, to see the commands it sends over a
+    # season (astro offsets and daylight saving time changes included) in a few
+    # seconds, and to measure the planning speed of the scheduler.
+    def __init__(self, log = None, schedule = None, config = None):
+        super(ScheduleSimulator, self).__init__()
+        self.log = log
+        self.schedule = schedule
+        self.config = config
+        self.commands = []      # (time, shutterId, action text, sent)
+        self.stats = {}
+
+    #---------------------ScheduleSimulator::getGroup---------------------------
+    # The shutters commanded through 'shutterId', as in Shutter.getGroup
+    def getGroup(self, shutterId):
+        return (shutterId,) + tuple(self.config.Shutters.get(shutterId, {}).get('groupMembers', []))
+
+    #---------------------ScheduleSimulator::run--------------------------------
+    # Simulate 'days' days from 'start' (now by default). The positions start
+    # unknown, the partial movements are canceled as ActionDispatcher does.
+    def run(self, days, start = None):
+        clock = VirtualClock(start)
+        scheduler = Scheduler(kwargs={'log': self.log, 'schedule': self.schedule, 'shutter': None, 'config': self.config, 'clock': clock})
+        begin = time.monotonic()
+        timeline = scheduler.simulate(days)
+        elapsed = time.monotonic() - begin
+
+        positions = {}
+        self.commands = []
+        for fireTime, event in timeline:
+            for shutterId in event.shutterIds:
+                position = positions.get(shutterId)
+                sent = (event.target == None) or (position == None) or \
+                       ((event.action == "up") and (position < event.target)) or \
+                       ((event.action == "down") and (position > event.target))
+                self.commands.append((fireTime, shutterId, event.getActionText(), sent))
+                if not sent:
+                    continue
+                if event.action == "stop":
+                    position = None
+                elif event.target != None:
+                    position = event.target
+                else:
+                    position = 100 if event.action == "up" else 0
+                for id in self.getGroup(shutterId):
+                    positions[id] = position
+
+        self.stats = {'rules': len(scheduler.events), 'days': days, 'fired': len(timeline),
+                      'commands': len(self.commands), 'seconds': elapsed,
+                      'firedPerSecond': (len(timeline) / elapsed) if elapsed > 0 else 0.0}
+        return self.stats
+
+    #---------------------ScheduleSimulator::printTimeline----------------------
+    def printTimeline(self):
+        for shutterId in sorted(set(command[1] for command in self.commands)):
+            name = self.config.Shutters[shutterId]['name'] if shutterId in self.config.Shutters else shutterId
+            print ("")
+            print ("Shutter: "+name+" ("+shutterId+")")
+            for fireTime, id, action, sent in self.commands:
+                if id == shutterId:
+                    print ("  "+fireTime.strftime("%a %Y/%m/%d %H:%M:%S")+"  "+action+("" if sent else "  (canceled, already there)"))
+        print ("")
+        print ("%(rules)d rules, %(fired)d events over %(days)d days, %(commands)d commands, planned in %(seconds).3f seconds (%(firedPerSecond).0f events per second)" % self.stats)
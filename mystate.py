@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import mmap
+import math
+import struct
+import threading
+
+try:
+    from mylog import MyLog
+except Exception as e1:
+    print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
+    print("Error: " + str(e1))
+    sys.exit(2)
+
+
+class StateSnapshot (MyLog):
+    # File layout: a header (magic, number of records) followed by one fixed
+    # size record per shutter. Records are updated in place through a memory
+    # map, so saving the state of a shutter touches a single record.
+    Magic = b'SOMFYST1'
+    Header = struct.Struct('<8sI')
+    # shutter address, position, target position, status, last status change (time.time())
+    Record = struct.Struct('<IffB3xd')
+    StatusCodes = {'stopped': 0, 'opening': 1, 'closing': 2}
+    StatusNames = {0: 'stopped', 1: 'opening', 2: 'closing'}
+
+    #---------------------StateSnapshot::__init__-------------------------------
+    def __init__(self, filename, capacity = 32, log = None):
+
+        super(StateSnapshot, self).__init__()
+        self.log = log
+        self.FileName = filename
+        self.Capacity = max(1, capacity)
+        self.Lock = threading.Lock()
+        self.File = None
+        self.Map = None
+        self.Slots = {}
+
+    #---------------------StateSnapshot::Open-----------------------------------
+    # Map the snapshot file, creating it if needed. Returns a dictionary
+    # shutterId -> (position, targetPosition, status, statusTime)
+    def Open(self):
+
+        states = {}
+        with self.Lock:
+            try:
+                if not os.path.isfile(self.FileName):
+                    with open(self.FileName, "wb") as SnapshotFile:
+                        SnapshotFile.write(self.Header.pack(self.Magic, 0))
+                self.File = open(self.FileName, "r+b")
+                size = os.fstat(self.File.fileno()).st_size
+                if (size < self.Header.size) or (self.File.read(len(self.Magic)) != self.Magic):
+                    self.LogError("Invalid state snapshot " + self.FileName + ", starting from scratch")
+                    size = 0
+                    self.File.seek(0)
+                    self.File.write(self.Header.pack(self.Magic, 0))
+                    self.File.truncate()
+                    self.File.flush()
+                capacity = max(self.Capacity, (size - self.Header.size) // self.Record.size)
+                self.Map = self.Resize(capacity)
+
+                magic, count = self.Header.unpack_from(self.Map, 0)
+                count = min(count, self.Capacity)
+                for slot in range(count):
+                    address, position, targetPosition, status, statusTime = self.Record.unpack_from(self.Map, self.Header.size + slot * self.Record.size)
+                    shutterId = hex(address)
+                    self.Slots[shutterId] = slot
+                    states[shutterId] = (None if math.isnan(position) else position,
+                                         None if math.isnan(targetPosition) else targetPosition,
+                                         self.StatusNames.get(status, 'stopped'), statusTime)
+            except Exception as e1:
+                self.LogErrorLine("Error in StateSnapshot:Open: " + str(e1))
+                self.Map = None
+        return states
+
+    #---------------------StateSnapshot::Resize---------------------------------
+    # Grow the file to hold 'capacity' records and map it. Called with the lock held.
+    def Resize(self, capacity):
+
+        if self.Map != None:
+            self.Map.close()
+        self.File.truncate(self.Header.size + capacity * self.Record.size)
+        self.Capacity = capacity
+        return mmap.mmap(self.File.fileno(), 0)
+
+    #---------------------StateSnapshot::Write----------------------------------
+    def Write(self, shutterId, position, targetPosition, status, statusTime):
+
+        with self.Lock:
+            if self.Map == None:
+                return False
+            try:
+                slot = self.Slots.get(shutterId)
+                if slot == None:
+                    slot = len(self.Slots)
+                    if slot >= self.Capacity:
+                        self.Map = self.Resize(self.Capacity * 2)
+                    self.Slots[shutterId] = slot
+                    self.Header.pack_into(self.Map, 0, self.Magic, len(self.Slots))
+                self.Record.pack_into(self.Map, self.Header.size + slot * self.Record.size, int(shutterId, 16),
+                                      float('nan') if position == None else position,
+                                      float('nan') if targetPosition == None else targetPosition,
+                                      self.StatusCodes.get(status, 0), statusTime)
+                return True
+            except Exception as e1:
+                self.LogError("Error in StateSnapshot:Write: " + str(e1))
+                return False
+
+    #---------------------StateSnapshot::Close----------------------------------
+    def Close(self):
+
+        with self.Lock:
+            try:
+                if self.Map != None:
+                    self.Map.flush()
+                    self.Map.close()
+                    self.Map = None
+                if self.File != None:
+                    self.File.close()
+                    self.File = None
+            except Exception as e1:
+                self.LogError("Error in StateSnapshot:Close: " + str(e1))
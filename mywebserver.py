@@ -34,13 +34,14 @@ class FlaskAppWrapper(MyLog):
     app = None
     CriticalLock = None
 
-    def __init__(self, name = __name__, static_url_path = '', log = None, shutter = None, schedule = None, config = None):
+    def __init__(self, name = __name__, static_url_path = '', log = None, shutter = None, schedule = None, config = None, scheduler = None):
         if log != None:
             self.log = log
         logging.getLogger('werkzeug').setLevel(logging.ERROR)
     
         self.shutter = shutter
         self.schedule = schedule
+        self.scheduler = scheduler
         self.config = config
         
         self.app = Flask(import_name=name, static_url_path="", static_folder=static_url_path)
@@ -79,7 +80,7 @@ class FlaskAppWrapper(MyLog):
             # self.LogDebug("JSON: "+str(request.get_json()))
             # self.LogDebug("RAW: "+str(request.get_data()))
             command = args[1]['command']
-            if command in ["up", "down", "stop", "program", "press", "getConfig", "addSchedule", "editSchedule", "deleteSchedule", "addShutter", "editShutter", "deleteShutter", "setLocation" ]:
+            if command in ["up", "down", "stop", "program", "press", "getConfig", "addSchedule", "editSchedule", "deleteSchedule", "addShutter", "editShutter", "deleteShutter", "setLocation", "getStatus" ]:
                 self.LogInfo("processing Command \"" + command + "\" with parameters: "+str(request.values))
                 result = getattr(self, command)(request.values)
                 return Response(json.dumps(result), status=200)
@@ -175,7 +176,7 @@ class FlaskAppWrapper(MyLog):
     def setLocation(self, params):
         self.LogDebug("set Location: "+params.get('lat', 0, type=str)+" / "+params.get('lng', 0, type=str))
         self.config.setLocation(params.get('lat', 0, type=str), params.get('lng', 0, type=str))
-        self.schedule.setUpdateTime()
+        self.schedule.locationChanged()
         return {'status': 'OK'}
 
     def addShutter(self, params):
@@ -207,11 +208,13 @@ class FlaskAppWrapper(MyLog):
             id = hex(tmp_id)
             code = 1
             self.LogDebug("got a new shutter id: "+id)
-            self.config.WriteValue(id, str(name)+",True,"+str(duration), section="Shutters");
-            self.config.WriteValue(id, str(code), section="ShutterRollingCodes");
-            self.config.WriteValue(id, str(None), section="ShutterIntermediatePositions");
+            with self.config.Transaction():
+                self.config.WriteValue(id, str(name)+",True,"+str(duration), section="Shutters");
+                self.config.WriteValue(id, str(code), section="ShutterRollingCodes");
+                self.config.WriteValue(id, str(None), section="ShutterIntermediatePositions");
             self.config.ShuttersByName[name] = id
-            self.config.Shutters[id] = {'name': name, 'code': code, 'duration': duration, 'intermediatePosition': None}
+            self.config.Shutters[id] = {'name': name, 'code': code, 'duration': duration, 'intermediatePosition': None, 'groupedShutterIds': []}
+            self.config.CompileGroups()
             return {'status': 'OK', 'id': id}
 
     def editShutter(self, params):
@@ -243,6 +246,7 @@ class FlaskAppWrapper(MyLog):
             self.config.ShuttersByName['name'] = id
             self.config.Shutters[id]['name'] = name
             self.config.Shutters[id]['duration'] = int(duration)
+            self.config.Shutters[id].pop('profile', None)
             return {'status': 'OK'}
 
     def deleteShutter(self, params):
@@ -255,6 +259,7 @@ class FlaskAppWrapper(MyLog):
             self.config.WriteValue(str(id), self.config.Shutters[id]['name']+",False,"+self.config.Shutters[id]['duration'], section="Shutters");
             self.config.ShuttersByName.pop(self.config.Shutters[id]['name'], None)
             self.config.Shutters.pop(id, None)
+            self.config.CompileGroups()
             return {'status': 'OK'}
 
     def addSchedule(self, params):
@@ -281,6 +286,16 @@ class FlaskAppWrapper(MyLog):
         self.LogDebug("getConfig called, sending: "+json.dumps(obj))
         return obj
 
+    def getStatus(self, params):
+        if not self.validatePassword():
+            return {'status': 'ERROR', 'message': 'Bad password'}
+        obj = self.shutter.getStats()
+        if self.scheduler != None:
+            obj['scheduler'] = self.scheduler.getStats()
+            obj['dispatcher'] = self.scheduler.dispatcher.getStats()
+            obj['sendReport'] = self.scheduler.dispatcher.getSendReport()
+        return obj
+
     def generate_adhoc_ssl_context(self):
         """Generates an adhoc SSL context for the development server."""
         #        crypto = _get_openssl_crypto_module()
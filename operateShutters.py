@@ -6,11 +6,12 @@ import fcntl
 import os
 import locale
 import time
+import copy
 import datetime
 import ephem
-import pigpio
 import socket
 import signal, atexit, traceback
+import tempfile
 import logging, logging.handlers
 import threading
 
@@ -21,9 +22,16 @@ try:
     from myscheduler import Event
     from myscheduler import Schedule
     from myscheduler import Scheduler
+    from myscheduler import ScheduleSimulator
     from mywebserver import FlaskAppWrapper
     from myalexa import Alexa
     from mymqtt import MQTT
+    from myradio import createRadio
+    from myradio import Transmitter
+    from mymotion import MotionEngine
+    from mymotion import PositionSubscriber
+    from mystate import StateSnapshot
+    from myevents import EventBus
     from shutil import copyfile
 except Exception as e1:
     print("\n\nThis program requires the modules located from the same github repository that are not present.\n")
@@ -38,23 +46,49 @@ class Shutter(MyLog):
     buttonProg = 0x8
 
     class ShutterState: # Definition of one shutter state
+        # The state stores the movement rather than the position: the position
+        # is computed from the starting position, the time of the last status
+        # change and the travel profile whenever somebody asks for it.
         status = 'stopped'
-        position = 100 # as percentage: 0 = closed (down), 100 = open (up)
-        startingPosition = 100
+        startingPosition = 100 # as percentage: 0 = closed (down), 100 = open (up)
+        targetPosition = None
+        profile = None # TravelProfile of the blind while it is moving
         lastStatusTime = None # get using time.monotonic()
 
         def __init__(self, initPosition = None):
-            self.position = initPosition
+            self.startingPosition = initPosition
             self.lastStatusTime = time.monotonic()
 
-        def setStatus(self, status):
-            self.status = status
-            self.startingPosition = self.position
+        def getPosition(self, now = None):
+            if (self.profile == None) or (self.startingPosition == None):
+                return self.startingPosition
+            if now == None:
+                now = time.monotonic()
+            return self.profile.getPosition(self.startingPosition, self.targetPosition, max(0.0, now - self.lastStatusTime))
+
+        position = property(getPosition)
+
+        def setPosition(self, position):
+            self.startingPosition = position
+            self.targetPosition = None
+            self.profile = None
             self.lastStatusTime = time.monotonic()
 
+        def setStatus(self, status, now = None):
+            if now == None:
+                now = time.monotonic()
+            self.startingPosition = self.getPosition(now)
+            self.targetPosition = None
+            self.profile = None
+            self.status = status
+            self.lastStatusTime = now
+
+        def setMotion(self, targetPosition, profile):
+            self.targetPosition = targetPosition
+            self.profile = profile
+
     def __init__(self, log = None, config = None):
         super(Shutter, self).__init__()
-        self.lock = threading.Lock()
         if log != None:
             self.log = log
         if config != None:
@@ -64,11 +98,62 @@ class Shutter(MyLog):
            self.TXGPIO=self.config.TXGPIO # 433.42 MHz emitter
         else:
            self.TXGPIO=4 # 433.42 MHz emitter on GPIO 4
-        self.frame = bytearray(7)
+        self.radio = createRadio(self.config, self.TXGPIO, log = self.log)
+        self.transmitter = Transmitter(kwargs={'log':self.log, 'config': self.config, 'radio': self.radio})
+        self.transmitter.start()
+        self.events = EventBus(log = self.log)
         self.positionCallback = []
         self.statusCallback = []
+        self.commandCallback = []
         self.shutterStateList = {}
         self.sutterStateLock = threading.Lock()
+        self.motion = MotionEngine(kwargs={'log':self.log, 'shutter': self, 'config': self.config})
+        self.motion.start()
+        self.snapshot = None
+        if self.config.FileName != None:
+            self.snapshot = StateSnapshot(self.config.FileName + ".state", log = self.log)
+            self.restoreState(self.snapshot.Open())
+
+    # Rebuild the state of the shutters saved by the previous run. A movement
+    # that was in progress is resumed by the motion engine, or completed if it
+    # should have ended in the meantime.
+    def restoreState(self, states):
+        now = time.monotonic()
+        wallNow = time.time()
+        moving = []
+        with self.sutterStateLock:
+            for shutterId, (position, targetPosition, status, statusTime) in states.items():
+                if (shutterId not in self.config.Shutters) or (position == None):
+                    continue
+                state = self.ShutterState(position)
+                state.lastStatusTime = now - max(0.0, wallNow - statusTime)
+                if (status != 'stopped') and (targetPosition != None):
+                    profile = self.config.getTravelProfile(shutterId)
+                    if profile.getTravelTime(position, targetPosition) > now - state.lastStatusTime:
+                        state.status = status
+                        state.setMotion(targetPosition, profile)
+                        moving.append(shutterId)
+                    else:
+                        state.startingPosition = targetPosition
+                self.shutterStateList[shutterId] = state
+        self.LogInfo("Restored the state of " + str(len(states)) + " shutters, " + str(len(moving)) + " moving")
+
+        # movements of a group are tracked for the group only
+        grouped = set(memberId for shutterId in moving for memberId in self.config.Shutters[shutterId].get('groupMembers', ()))
+        for shutterId in moving:
+            if shutterId not in grouped:
+                state = self.shutterStateList[shutterId]
+                self.motion.move(shutterId, state.startingPosition, state.targetPosition, state.lastStatusTime)
+
+    # Save the state of the shutters in the snapshot
+    def saveState(self, shutterIds):
+        if self.snapshot == None:
+            return
+        offset = time.time() - time.monotonic()
+        for shutterId in shutterIds:
+            state = self.shutterStateList.get(shutterId)
+            if state != None:
+                self.snapshot.Write(shutterId, state.startingPosition, state.targetPosition, state.status, state.lastStatusTime + offset)
 
     def getShutterState(self, shutterId, initialPosition = None):
         with self.sutterStateLock:
@@ -78,50 +163,87 @@ class Shutter(MyLog):
 
     def getPosition(self, shutterId):
         state = self.getShutterState(shutterId, 0)
-        return state.position
+        position = state.getPosition()
+        return int(round(position)) if position != None else None
 
-    def setPosition(self, shutterId, newPosition):
-        state = self.getShutterState(shutterId)
-        with self.sutterStateLock:
-            state.position = newPosition
-        for function in self.positionCallback:
-            function(shutterId, newPosition)
+    # The shutter followed by all the shutters it controls through groups,
+    # as flattened by the config when it is loaded or edited
+    def getGroup(self, shutterId):
+        return (shutterId,) + self.config.Shutters[shutterId].get('groupMembers', ())
 
+    def setPosition(self, shutterId, newPosition):
         # Update the position of any shutters grouped with this one
-        for childId in self.config.Shutters[shutterId]['groupedShutterIds']:
-            self.setPosition(childId, newPosition)
-
-    def setStatus(self, shutterId, status):
-        state = self.getShutterState(shutterId)
+        group = self.getGroup(shutterId)
+        states = [self.getShutterState(memberId) for memberId in group]
+        with self.sutterStateLock:
+            for state in states:
+                state.setPosition(newPosition)
+        self.saveState(group)
+
+        position = int(round(newPosition))
+        updates = [(memberId, position) for memberId in group]
+        for subscriber in self.positionCallback:
+            subscriber.notify(updates)
+
+    # Called periodically by the motion engine while a blind is moving. Only the
+    # subscribers asking for updates at this rate are notified.
+    def publishPosition(self, shutterId):
+        now = time.monotonic()
+        updates = []
+        for memberId in self.getGroup(shutterId):
+            position = self.getShutterState(memberId).getPosition(now)
+            if position != None:
+                updates.append((memberId, int(round(position))))
+        for subscriber in self.positionCallback:
+            subscriber.notify(updates, now, periodic = True)
+
+    # Smallest update interval asked by the position subscribers, None if no subscriber wants periodic updates
+    def getPublishInterval(self):
+        intervals = [subscriber.interval for subscriber in self.positionCallback if subscriber.interval != None]
+        return min(intervals) if len(intervals) else None
+
+    def setStatus(self, shutterId, status, now = None):
+        # Update the status of any shutters grouped with this one
+        group = self.getGroup(shutterId)
+        states = [self.getShutterState(memberId) for memberId in group]
+        # Any new status ends the movement the motion engine was tracking
+        for memberId in group:
+            self.motion.cancel(memberId)
         with self.sutterStateLock:
-            state.setStatus(status)
+            # a member whose own position is unknown takes the position of the group
+            positions = [state.getPosition(now) for state in states if state.startingPosition != None]
+            for state in states:
+                if (state.startingPosition == None) and len(positions):
+                    state.setPosition(positions[0])
+                state.setStatus(status, now)
+        self.saveState(group)
 
         for function in self.statusCallback:
-            function(shutterId, status)
-
-        # Update the position of any shutters grouped with this one
-        for childId in self.config.Shutters[shutterId]['groupedShutterIds']:
-            self.setStatus(childId, status)
-
-    def waitAndSetFinalPosition(self, shutterId, startingPosition, targetPosition):
-        state = self.getShutterState(shutterId)
-        oldlastStatusTime = state.lastStatusTime
-
-        timeToWait = (abs(startingPosition - targetPosition)/100)*self.config.Shutters[shutterId]['duration']
-        waited = 0
-
-        self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Waiting for operation to complete for " + str(timeToWait) + " seconds")
-        while timeToWait > waited:
-
-            self.setPosition(shutterId, int(startingPosition + (targetPosition - startingPosition) * waited / timeToWait))
-            time.sleep(min(timeToWait - waited,1))
-            waited += 1
-
-            # Cancel, if another command has been called in between
-            if state.lastStatusTime != oldlastStatusTime:
-                self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Discard final position. Position is now: " + str(state.position))
-                return
+            for memberId in group:
+                function(memberId, status)
+
+    # Record the movement that just started (after setStatus) and let the motion engine track it
+    def startMotion(self, shutterId, startingPosition, targetPosition, startTime = None):
+        if startingPosition == None:
+            startingPosition = self.motion.getAssumedStart(targetPosition)
+            states = [self.getShutterState(memberId) for memberId in self.getGroup(shutterId)]
+            with self.sutterStateLock:
+                for state in states:
+                    if state.startingPosition == None:
+                        state.startingPosition = startingPosition
+        self.setMotion(shutterId, targetPosition)
+        self.motion.move(shutterId, startingPosition, targetPosition, startTime)
+
+    def setMotion(self, shutterId, targetPosition):
+        group = self.getGroup(shutterId)
+        states = [(self.getShutterState(memberId), self.config.getTravelProfile(memberId)) for memberId in group]
+        with self.sutterStateLock:
+            for state, profile in states:
+                state.setMotion(targetPosition, profile)
+        self.saveState(group)
 
+    # Called by the motion engine once a blind has reached its target position
+    def motionComplete(self, shutterId, targetPosition):
         self.LogDebug("["+self.config.Shutters[shutterId]['name']+"] Blind has reached new final position: " + str(targetPosition))
 
         # Stop the shutter, if this is a partial movement (Risky if you're moving very close to the end of travel!)
@@ -132,224 +254,244 @@ class Shutter(MyLog):
         self.setPosition(shutterId, targetPosition)
         self.setStatus(shutterId, 'stopped')
 
-    def lower(self, shutterId):
+    def lower(self, shutterId, priority = None):
         state = self.getShutterState(shutterId, 100)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down to the bottom")
-        self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
-        
-        self.setStatus(shutterId, 'closing')
+        future = self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat, priority)
+        if self.isRejected(future):
+            return future
+        onAirTime = self.transmitter.estimateOnAirTime()
+        self.setStatus(shutterId, 'closing', onAirTime)
 
-        # wait and set final position only if not interrupted in between
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, state.startingPosition, 0))
-        t.start()
+        # set final position only if not interrupted in between
+        self.startMotion(shutterId, state.startingPosition, 0, onAirTime)
+        future.add_done_callback(lambda future: self.retimeMotion(shutterId, onAirTime, future))
+        return future
 
     def lowerPartial(self, shutterId, percentage):
         state = self.getShutterState(shutterId, 100)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going down to" + str(percentage)) 
-        self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
-        self.setStatus(shutterId, 'closing')
+        future = self.sendCommand(shutterId, self.buttonDown, self.config.SendRepeat)
+        if self.isRejected(future):
+            return future
+        onAirTime = self.transmitter.estimateOnAirTime()
+        self.setStatus(shutterId, 'closing', onAirTime)
 
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, state.startingPosition, percentage))
-        t.start()
+        self.startMotion(shutterId, state.startingPosition, percentage, onAirTime)
+        future.add_done_callback(lambda future: self.retimeMotion(shutterId, onAirTime, future))
+        return future
 
-    def rise(self, shutterId):
+    def rise(self, shutterId, priority = None):
         state = self.getShutterState(shutterId, 0)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going up to the top")
-        self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
-        self.setStatus(shutterId, 'opening')
+        future = self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat, priority)
+        if self.isRejected(future):
+            return future
+        onAirTime = self.transmitter.estimateOnAirTime()
+        self.setStatus(shutterId, 'opening', onAirTime)
 
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, state.startingPosition, 100))
-        t.start()
+        self.startMotion(shutterId, state.startingPosition, 100, onAirTime)
+        future.add_done_callback(lambda future: self.retimeMotion(shutterId, onAirTime, future))
+        return future
 
     def risePartial(self, shutterId, percentage):
         state = self.getShutterState(shutterId, 0)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Going up to " + str(percentage))
-        self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
-        self.setStatus(shutterId, 'opening')
+        future = self.sendCommand(shutterId, self.buttonUp, self.config.SendRepeat)
+        if self.isRejected(future):
+            return future
+        onAirTime = self.transmitter.estimateOnAirTime()
+        self.setStatus(shutterId, 'opening', onAirTime)
 
-        t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, state.startingPosition, percentage))
-        t.start()
+        self.startMotion(shutterId, state.startingPosition, percentage, onAirTime)
+        future.add_done_callback(lambda future: self.retimeMotion(shutterId, onAirTime, future))
+        return future
 
     def stop(self, shutterId):
         state = self.getShutterState(shutterId, 50)
 
         self.LogInfo("["+self.config.Shutters[shutterId]['name']+"] Stopping")
-        self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
-
-        self.LogDebug("["+shutterId+"] Previous position: " + str(state.startingPosition))
-        secondsSinceLastCommand = int(round(time.monotonic() - state.lastStatusTime))
-        self.LogDebug("["+shutterId+"] Seconds since last command: " + str(secondsSinceLastCommand))
+        future = self.sendCommand(shutterId, self.buttonStop, self.config.SendRepeat)
+        if self.isRejected(future):
+            return future
+        stopTime = self.transmitter.estimateOnAirTime()
+        with self.sutterStateLock:
+            movement = copy.copy(state)
 
-        # Compute position based on time elapsed since last command & command direction
-        setupDuration = self.config.Shutters[shutterId]['duration']
+        self.LogDebug("["+shutterId+"] Previous position: " + str(movement.startingPosition))
+        newPosition = self.getStopPosition(shutterId, movement, stopTime)
 
-        fallback = False
-        if state.status == "stopped":
-            self.LogInfo("["+shutterId+"] Stop pressed while stationary.")
-            fallback = True
-        elif secondsSinceLastCommand > 0 and secondsSinceLastCommand < setupDuration:
-            # Work out how far we moved before we stopped
-            durationPercentage = int(round(secondsSinceLastCommand/setupDuration * 100))
-            self.LogDebug("["+shutterId+"] Duration percentage: " + str(durationPercentage) + ", Starting position: "+ str(state.startingPosition))
-            if state.status == 'opening':
-                newPosition = min (100 , state.startingPosition + durationPercentage)
-            else:
-                newPosition = max (0 , state.startingPosition - durationPercentage)
-        else:  #improbable
-            self.LogWarn("["+shutterId+"] Too much time since last command.")
-            fallback = True
-
-        if fallback == True: # Let's assume it will end on the intermediate position ! If it exists !
+        if newPosition == None: # Let's assume it will end on the intermediate position ! If it exists !
             intermediatePosition = self.config.Shutters[shutterId]['intermediatePosition']
             if (intermediatePosition == None) or (intermediatePosition == state.position):
                 # The blind may be moving, but we have no idea
                 self.LogInfo("["+shutterId+"] Intermediate position not defined. Assuming blind will stay stationary.")
                 newPosition = state.position
+            elif state.position == None:
+                # the blind may be moving, there is no way to know where from
+                self.LogInfo("["+shutterId+"] Position unknown. Assuming blind will end at intermediate position "+str(intermediatePosition))
+                newPosition = intermediatePosition
             else:
                 self.LogInfo("["+shutterId+"] Motor is probably moving to intermediate position "+str(intermediatePosition))
                 if state.position > intermediatePosition:
                     self.setStatus(shutterId, 'closing')
                 else:
                     self.setStatus(shutterId, 'opening')
-                # wait and set final intermediate position only if not interrupted in between
-                t = threading.Thread(target = self.waitAndSetFinalPosition, args = (shutterId, state.position, intermediatePosition))
-                t.start()
-                return
+                # set final intermediate position only if not interrupted in between
+                self.startMotion(shutterId, state.startingPosition, intermediatePosition)
+                return future
 
         # Save computed approximate position
-        self.setPosition(shutterId, newPosition)
-        self.setStatus(shutterId, 'stopped')
+        if newPosition != None:
+            self.setPosition(shutterId, newPosition)
+        self.setStatus(shutterId, 'stopped', stopTime)
+        future.add_done_callback(lambda future: self.retimeStop(shutterId, movement, stopTime, future))
+        return future
+
+    # Position of a blind moving as described by 'state' when it receives a stop
+    # at 'stopTime'. Returns None if there is no way to know.
+    def getStopPosition(self, shutterId, state, stopTime):
+        secondsSinceLastCommand = max(0.0, stopTime - state.lastStatusTime)
+        self.LogDebug("["+shutterId+"] Seconds since last command: " + "%.3f" % secondsSinceLastCommand)
+
+        # Compute position based on time elapsed since last command & command direction
+        profile = self.config.getTravelProfile(shutterId)
+        endPosition = 100 if state.status == 'opening' else 0
+        if state.targetPosition != None:
+            endPosition = state.targetPosition
+
+        if state.status == "stopped":
+            self.LogInfo("["+shutterId+"] Stop pressed while stationary.")
+            return None
+        elif state.startingPosition == None:
+            self.LogInfo("["+shutterId+"] Stop pressed while moving from an unknown position.")
+            return None
+        elif secondsSinceLastCommand < profile.getDuration(state.startingPosition, endPosition):
+            # Work out how far we moved before we stopped
+            newPosition = profile.getPosition(state.startingPosition, endPosition, secondsSinceLastCommand)
+            self.LogDebug("["+shutterId+"] Estimated position: " + "%.2f" % newPosition + ", Starting position: "+ str(state.startingPosition))
+            return newPosition
+        else:  #improbable
+            self.LogWarn("["+shutterId+"] Too much time since last command.")
+            return None
+
+    # True if the transmitter refused the command (queue full): the blind will not move
+    def isRejected(self, future):
+        if future.done() and not future.cancelled() and (future.exception() != None):
+            self.LogWarn("Command refused by the transmitter, the blind state is left unchanged: " + str(future.exception()))
+            return True
+        return False
+
+    # Time a sent command was acted upon, None if it was not sent
+    def getOnAirTime(self, future):
+        if future.cancelled() or (future.exception() != None):
+            return None
+        return future.result()['onAirTime']
+
+    # Called once the command starting a movement has been sent: the movement
+    # started when the frame was on air, not when we expected it to be.
+    def retimeMotion(self, shutterId, estimatedTime, future):
+        onAirTime = self.getOnAirTime(future)
+        if (onAirTime == None) or (onAirTime == estimatedTime):
+            return
+        if self.motion.retime(shutterId, estimatedTime, onAirTime):
+            self.retimeState(shutterId, estimatedTime, onAirTime)
+
+    def retimeState(self, shutterId, estimatedTime, onAirTime):
+        group = self.getGroup(shutterId)
+        states = [self.getShutterState(memberId) for memberId in group]
+        with self.sutterStateLock:
+            for state in states:
+                if state.lastStatusTime == estimatedTime:
+                    state.lastStatusTime = onAirTime
+        self.saveState(group)
+
+    # Called once the stop command has been sent: correct the position the blind
+    # stopped at with the time the frame was actually on air.
+    def retimeStop(self, shutterId, movement, estimatedTime, future):
+        onAirTime = self.getOnAirTime(future)
+        if (onAirTime == None) or (onAirTime == estimatedTime):
+            return
+        state = self.getShutterState(shutterId)
+        with self.sutterStateLock:
+            if (state.status != 'stopped') or (state.lastStatusTime != estimatedTime):
+                return  # the blind has been moved since
+        newPosition = self.getStopPosition(shutterId, movement, onAirTime)
+        if newPosition != None:
+            self.setPosition(shutterId, newPosition)
 
     # Push a set of buttons for a short or long press.
     def pressButtons(self, shutterId, buttons, longPress):
-        self.sendCommand(shutterId, buttons, 35 if longPress else 1)
+        return self.sendCommand(shutterId, buttons, 35 if longPress else 1, Transmitter.priorityPress)
 
     def program(self, shutterId):
-        self.sendCommand(shutterId, self.buttonProg, 1)
-
-    def registerPositionCallBack(self, callbackFunction):
-        self.positionCallback.append(callbackFunction)
+        return self.sendCommand(shutterId, self.buttonProg, 1, Transmitter.priorityPress)
+
+    # Expected end (time.monotonic()) of the transmission currently on air
+    def getTransmitEndTime(self):
+        return self.radio.getTxEndTime()
+
+    # While a blind moves, the callback is called every 'interval' seconds (never
+    # if None), and only if the position changed by at least 'minDelta' percent.
+    # Final positions are always reported.
+    # The callbacks are called on a thread of the event bus, never on the thread changing the state.
+    def registerPositionCallBack(self, callbackFunction, interval = 1.0, minDelta = None):
+        subscription = self.events.subscribe(callbackFunction)
+        self.positionCallback.append(PositionSubscriber(subscription.put, interval, minDelta))
+        # movements already tracked (restored at startup) are published at the new rate too
+        self.motion.updatePublishing()
 
     def registerStateCallBack(self, callbackFunction):
-        self.statusCallback.append(callbackFunction)
+        self.statusCallback.append(self.events.subscribe(callbackFunction).put)
 
-    def sendCommand(self, shutterId, button, repetition): #Sending a frame
+    # 'callbackFunction(shutterId, button)' is called on the thread sending each command
+    def registerCommandCallBack(self, callbackFunction):
+        self.commandCallback.append(callbackFunction)
+
+    def sendCommand(self, shutterId, button, repetition, priority = None): #Sending a frame
     # Sending more than two repetitions after the original frame means a button kept pressed and moves the blind in steps 
     # to adjust the tilt. Sending the original frame and three repetitions is the smallest adjustment, sending the original
     # frame and more repetitions moves the blinds up/down for a longer time.
     # To activate the program mode (to register or de-register additional remotes) of your Somfy blinds, long press the 
     # prog button (at least thirteen times after the original frame to activate the registration.
-       self.LogDebug("sendCommand: Waiting for Lock")
-       self.lock.acquire()
-       try:
-           self.LogDebug("sendCommand: Lock aquired")
-           checksum = 0
-
-           teleco = int(shutterId, 16)
-           code = int(self.config.Shutters[shutterId]['code'])
-
-           # print (codecs.encode(shutterId, 'hex_codec'))
-           self.config.setCode(shutterId, code+1)
-
-           pi = pigpio.pi() # connect to Pi
-
-           if not pi.connected:
-              exit()
-
-           pi.wave_add_new()
-           pi.set_mode(self.TXGPIO, pigpio.OUTPUT)
-
-           self.LogInfo ("Remote  :      " + "0x%0.2X" % teleco + ' (' + self.config.Shutters[shutterId]['name'] + ')')
-           self.LogInfo ("Button  :      " + "0x%0.2X" % button)
-           self.LogInfo ("Rolling code : " + str(code))
-           self.LogInfo ("")
-
-           self.frame[0] = 0xA7;       # Encryption key. Doesn't matter much
-           self.frame[1] = button << 4 # Which button did  you press? The 4 LSB will be the checksum
-           self.frame[2] = code >> 8               # Rolling code (big endian)
-           self.frame[3] = (code & 0xFF)           # Rolling code
-           self.frame[4] = teleco >> 16            # Remote address
-           self.frame[5] = ((teleco >>  8) & 0xFF) # Remote address
-           self.frame[6] = (teleco & 0xFF)         # Remote address
-
-           outstring = "Frame  :    "
-           for octet in self.frame:
-              outstring = outstring + "0x%0.2X" % octet + ' '
-           self.LogInfo (outstring)
-
-           for i in range(0, 7):
-              checksum = checksum ^ self.frame[i] ^ (self.frame[i] >> 4)
-
-           checksum &= 0b1111; # We keep the last 4 bits only
-
-           self.frame[1] |= checksum;
-
-           outstring = "With cks  : "
-           for octet in self.frame:
-              outstring = outstring + "0x%0.2X" % octet + ' '
-           self.LogInfo (outstring)
-
-           for i in range(1, 7):
-              self.frame[i] ^= self.frame[i-1];
-
-           outstring = "Obfuscated :"
-           for octet in self.frame:
-              outstring = outstring + "0x%0.2X" % octet + ' '
-           self.LogInfo (outstring)
-
-           #This is where all the awesomeness is happening. You're telling the daemon what you wanna send
-           wf=[]
-           wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 9415)) # wake up pulse
-           wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 89565)) # silence
-           for i in range(2): # hardware synchronization
-              wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 2560))
-              wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 2560))
-           wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 4550)) # software synchronization
-           wf.append(pigpio.pulse(0, 1<<self.TXGPIO,  640))
-
-           for i in range (0, 56): # manchester enconding of payload data
-              if ((self.frame[int(i/8)] >> (7 - (i%8))) & 1):
-                 wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-                 wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-              else:
-                 wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                 wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-
-           wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 30415)) # interframe gap
-
-           for j in range(1,repetition): # repeating frames
-                    for i in range(7): # hardware synchronization
-                          wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 2560))
-                          wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 2560))
-                    wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 4550)) # software synchronization
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO,  640))
-
-                    for i in range (0, 56): # manchester enconding of payload data
-                          if ((self.frame[int(i/8)] >> (7 - (i%8))) & 1):
-                             wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-                             wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                          else:
-                             wf.append(pigpio.pulse(1<<self.TXGPIO, 0, 640))
-                             wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 640))
-
-                    wf.append(pigpio.pulse(0, 1<<self.TXGPIO, 30415)) # interframe gap
-                    # time.sleep(0.25) # small pause before repetition, see issue #45
-
-           pi.wave_add_generic(wf)
-           wid = pi.wave_create()
-           pi.wave_send_once(wid)
-           while pi.wave_tx_busy():
-              pass
-           pi.wave_delete(wid)
-
-           pi.stop()
-       finally:
-           self.lock.release()
-           self.LogDebug("sendCommand: Lock released")
+    # The command is queued for the transmitter thread, the returned Future completes once it has been sent.
+        # STOP and any command for a blind that is moving go ahead of other commands
+        if priority == None:
+            state = self.shutterStateList.get(shutterId)
+            if (button == self.buttonStop) or ((state != None) and (state.status != 'stopped')):
+                priority = Transmitter.priorityStop
+            else:
+                priority = Transmitter.priorityMove
+        for callback in self.commandCallback:
+            callback(shutterId, button)
+        return self.transmitter.submit(shutterId, button, repetition, priority)
+
+    # Counters of the transmitter, the radio and the event bus
+    def getStats(self):
+        return {'transmitter': self.transmitter.getStats(), 'radio': self.radio.getHealth(), 'events': self.events.getStats()}
+
+    # Wait until all queued commands have been transmitted
+    def waitForTransmissions(self):
+        self.transmitter.flush()
+
+    # Wait until the blinds that move have arrived, and their STOP (partial movements) is queued
+    def waitForMotions(self):
+        self.motion.waitIdle()
+
+    # Stop the threads and release the radio and the state snapshot. Each step
+    # runs even if the previous one failed.
+    def close(self):
+        for step in (self.motion.shutdown, self.events.close, self.transmitter.shutdown, self.radio.close):
+            try:
+                step()
+            except Exception as e1:
+                self.LogError("Error while closing the shutters: " + str(e1))
+        if self.snapshot != None:
+            self.snapshot.Close()
 
 class operateShutters(MyLog):
 
@@ -360,6 +502,11 @@ class operateShutters(MyLog):
         self.log = None
         self.IsStopping = False
         self.ProgramComplete = False
+        self.shutter = None
+        self.scheduler = None
+        self.webServer = None
+        self.alexa = None
+        self.mqtt = None
 
         if args.ConfigFile == None:
             self.ConfigFile = "/etc/operateShutters.conf"
@@ -368,10 +515,6 @@ class operateShutters(MyLog):
 
         self.console = SetupLogger("shutters_console", log_file = "", stream = True)
 
-        if os.geteuid() != 0:
-            self.LogConsole("You need to have root privileges to run this script.\nPlease try again, this time using 'sudo'.")
-            sys.exit(1)
-
         if not os.path.isfile(self.ConfigFile):
             self.LogConsole("Creating new config file : " + self.ConfigFile)
             defaultConfigFile = os.path.dirname(os.path.realpath(__file__))+'/defaultConfig.conf'
@@ -383,33 +526,50 @@ class operateShutters(MyLog):
                 copyfile(defaultConfigFile, self.ConfigFile)
 
         # read config file
-        self.config = MyConfig(filename = self.ConfigFile, log = self.console)
+        # the simulation must not write the conf file a running instance uses
+        self.config = MyConfig(filename = self.ConfigFile, log = self.console, readOnly = args.simulate != None)
         result = self.config.LoadConfig();
         if not result:
             self.LogConsole("Failure to load configuration parameters")
             sys.exit(1)
 
+        if args.radio != None:
+            self.config.Radio = args.radio
+
+        # The simulation neither sends anything nor touches the state of a running instance
+        if args.simulate != None:
+            self.Simulate(args.simulate)
+            self.ProgramComplete = True
+            return
+
+        # The simulated radio doesn't need any hardware, hence no root privileges either
+        if (self.config.Radio == "pigpio") and (os.geteuid() != 0):
+            self.LogConsole("You need to have root privileges to run this script.\nPlease try again, this time using 'sudo'.")
+            sys.exit(1)
+
         # log errors in this module to a file
         self.log = SetupLogger("shutters", self.config.LogLocation + "operateShutters.log")
         self.config.log = self.log
+        if self.config.CodeJournal != None:
+            self.config.CodeJournal.log = self.log
 
         if self.IsLoaded():
             self.LogWarn("operateShutters.py is already loaded.")
             sys.exit(1)
 
-        if not self.startPIGPIO():
+        if (self.config.Radio == "pigpio") and not self.startPIGPIO():
             self.LogConsole("Not able to start PIGPIO")
             sys.exit(1)
 
         self.shutter = Shutter(log = self.log, config = self.config)
+        if not self.shutter.radio.connect():
+            self.LogError("Not able to connect to the radio, will retry on first transmission")
 
         # atexit.register(self.Close)
         # signal.signal(signal.SIGTERM, self.Close)
         # signal.signal(signal.SIGINT, self.Close)
 
         self.schedule = Schedule(log = self.log, config = self.config)
-        self.scheduler = None
-        self.webServer = None
 
         if (args.echo == True):
             self.alexa = Alexa(kwargs={'log':self.log, 'shutter': self.shutter, 'config': self.config})
@@ -417,13 +577,18 @@ class operateShutters(MyLog):
         if (args.mqtt == True):
             self.mqtt = MQTT(kwargs={'log':self.log, 'shutter': self.shutter, 'config': self.config})
 
-        self.ProcessCommand(args);
+        try:
+            self.ProcessCommand(args);
+        finally:
+            # a command that failed still releases the radio (the waves on pigpiod)
+            self.shutter.close()
 
     #------------------------ operateShutters::IsLoaded -----------------------------
     #return true if program is already loaded
     def IsLoaded(self):
 
-        file_path = '/var/lock/'+os.path.basename(__file__)
+        lock_dir = '/var/lock/' if os.geteuid() == 0 else tempfile.gettempdir() + '/'
+        file_path = lock_dir+os.path.basename(__file__)
         global file_handle
 
         try:
@@ -458,12 +623,6 @@ class operateShutters(MyLog):
            pigpiod_process = process
            self.LogInfo ("pigpiod is running, process ID is {} ".format(pigpiod_process))
 
-           try:
-               pi = pigpio.pi()  # local GPIO only
-               self.LogInfo ("pigpio's pi instantiated")
-           except Exception as e:
-               start_pigpiod_exception = str(e)
-               self.LogError ("problem instantiating pi: {}".format(start_pigpiod_exception))
        else:
            self.LogError ("start pigpiod was unsuccessful.")
            return False
@@ -529,7 +688,7 @@ class operateShutters(MyLog):
              if (args.mqtt == True):
                  self.mqtt.setDaemon(True)
                  self.mqtt.start()
-             self.webServer = FlaskAppWrapper(name='WebServer', static_url_path=os.path.dirname(os.path.realpath(__file__))+'/html', log = self.log, shutter = self.shutter, schedule = self.schedule, config = self.config)
+             self.webServer = FlaskAppWrapper(name='WebServer', static_url_path=os.path.dirname(os.path.realpath(__file__))+'/html', log = self.log, shutter = self.shutter, schedule = self.schedule, config = self.config, scheduler = self.scheduler)
              self.webServer.run()
        else:
           parser.print_help()
@@ -545,9 +704,22 @@ class operateShutters(MyLog):
            self.alexa.join()
        if (args.mqtt == True):
            self.mqtt.join()
+       if (args.auto != True):
+           # Close() stops the motion engine, which sends the STOP of the partial movements
+           self.shutter.waitForMotions()
+       self.shutter.waitForTransmissions()
        self.LogInfo ("Process Command Completed....")
        self.Close();
 
+    #---------------------operateShutters::Simulate-------------------------------------
+    def Simulate(self, days):
+        log = SetupLogger("shutters_simulation", log_file = "", level = logging.INFO, stream = True)
+        self.schedule = Schedule(log = log, config = self.config)
+        self.schedule.loadScheudleFromConfig()
+        simulator = ScheduleSimulator(log = log, schedule = self.schedule, config = self.config)
+        simulator.run(days)
+        simulator.printTimeline()
+
     #---------------------operateShutters::Close----------------------------------------
     def Close(self, signum = None, frame = None):
 
@@ -564,6 +736,7 @@ class operateShutters(MyLog):
             if (not self.scheduler == None):
                 self.LogError("Stopping Scheduler. This can take up to 1 second...")
                 self.scheduler.shutdown_flag.set()
+                self.scheduler.wakeup()
                 self.scheduler.join()
                 self.LogError("Scheduler stopped. Now exiting.")
             if (not self.alexa == None):
@@ -583,6 +756,11 @@ class operateShutters(MyLog):
             sys.exit(0)
         except:
             pass
+        finally:
+            # whatever happened to the listeners, the radio and the files are released
+            if self.shutter != None:
+                self.shutter.close()
+            self.config.Flush()
 
 #------------------- Command-line interface for monitor ------------------------
 
@@ -601,6 +779,8 @@ if __name__ == '__main__':
     parser.add_argument('-auto', '-a', help='Run schedule based on config. Also will start up the web-server which can be used to setup the schedule. Try: https://'+socket.gethostname(), action='store_true')
     parser.add_argument('-echo', '-e', help='Enable Amazon Alexa (Echo) integration', action='store_true')
     parser.add_argument('-mqtt', '-m', help='Enable MQTT integration', action='store_true')
+    parser.add_argument('-radio', choices=['pigpio', 'simulated'], help='Radio backend, overrides the Radio setting of the config file. \'simulated\' runs without any RF hardware', default=None)
+    parser.add_argument('-simulate', type=int, nargs='?', const=365, metavar='DAYS', help='Print the commands the schedule of the config file would send over the next DAYS days (365 by default), computed on a virtual clock without sending anything, and how long the planning took')
     args = parser.parse_args()
 
     #Start things up